@@ -1874,7 +1874,7 @@ There is NO warranty; not even for MERCHANTABILITY or FITNESS FOR A PARTICULAR P
           else:
             return ''
 
-        src = re.sub(shared.JS.memory_initializer_pattern, repl, open(final).read(), count=1)
+        src = shared.JS.memory_initializer_pattern.sub(repl, open(final).read(), count=1)
         open(final + '.mem.js', 'w').write(src)
         final += '.mem.js'
         src = None
@@ -8553,3 +8553,151 @@ T6:(else) !NO_EXIT_RUNTIME""", output)
     ret = run_process(NODE_JS + [os.path.join('subdir', 'a.js')], stdout=PIPE).stdout
     self.assertContained('hello, world!', ret)
 
+
+  # Tests that the persistent llvm-nm cache does not collect the temp files a
+  # build makes, which get new names every time
+  def test_llvm_nm_cache_skips_temp_files(self):
+    nm_cache = os.path.join(Cache.dirname, 'nm_cache.json')
+    try_delete(nm_cache)
+    with open('main.c', 'w') as f:
+      f.write(r'''
+        #include <stdio.h>
+        int other();
+        int main() {
+          printf("other: %d\n", other());
+          return 0;
+        }
+      ''')
+    with open('other.c', 'w') as f:
+      f.write('int other() { return 42; }\n')
+    run_process([PYTHON, EMCC, 'main.c', 'other.c', '-o', 'a.js'])
+    self.assertContained('other: 42', run_js('a.js'))
+    if not os.path.exists(nm_cache):
+      return
+    with open(nm_cache) as f:
+      files = json.load(f)['files']
+    cache_dir = os.path.join(Cache.dirname, '')
+    temp_dirs = [os.path.join(os.path.abspath(d), '') for d in (TEMP_DIR, CANONICAL_TEMP_DIR)]
+    for filename in files:
+      if not filename.startswith(cache_dir):
+        assert not any(filename.startswith(d) for d in temp_dirs), 'temp file in llvm-nm cache: ' + filename
+
+  def test_parse_setting_value(self):
+    parse = tools.shared.Settings.parse_setting_value
+    # the usual values are Python literals
+    self.assertEqual(parse('1'), 1)
+    self.assertEqual(parse('"foo"'), 'foo')
+    self.assertEqual(parse('["_main", "_foo"]'), ['_main', '_foo'])
+    self.assertEqual(parse('[]'), [])
+    # anything else is still evaluated as before
+    self.assertEqual(parse('32*1024*1024'), 32 * 1024 * 1024)
+    self.assertEqual(parse('1 + 2'), 3)
+    # and the same goes through emcc
+    run_process([PYTHON, EMCC, path_from_root('tests', 'hello_world.c'), '-s', 'TOTAL_MEMORY=32*1024*1024', '-s', 'EXPORTED_FUNCTIONS=["_main"]'])
+    self.assertContained('hello, world!', run_js('a.out.js'))
+
+  # Tests that which() finds programs through the PATH index, and does not
+  # remember programs that are missing
+  def test_which_path_index(self):
+    if WINDOWS: self.skipTest('tests POSIX executable bits')
+    bin_dir = os.path.abspath('bin')
+    os.mkdir(bin_dir)
+    tool = os.path.join(bin_dir, 'emscripten_test_tool')
+    old_path = os.environ['PATH']
+    os.environ['PATH'] = bin_dir + os.pathsep + old_path
+    try:
+      self.assertEqual(Building.which('emscripten_test_tool'), None)
+      # installed after a failed lookup, and after the index was built
+      with open(tool, 'w') as f:
+        f.write('#!/bin/sh\n')
+      os.chmod(tool, 0o755)
+      self.assertEqual(Building.which('emscripten_test_tool'), tool)
+      self.assertEqual(Building.which('emscripten_test_tool'), tool)
+      # no longer executable
+      os.chmod(tool, 0o644)
+      self.assertEqual(Building.which('emscripten_test_tool'), None)
+      os.remove(tool)
+      self.assertEqual(Building.which('emscripten_test_tool'), None)
+    finally:
+      os.environ['PATH'] = old_path
+
+  def test_nm_cache_lru(self):
+    cache = tools.shared.NmCache(max_entries=3)
+    for key in 'abc':
+      cache[key] = key.upper()
+    # reads keep an entry alive, so the least recently used one goes first
+    self.assertEqual(cache['a'], 'A')
+    self.assertEqual(cache.get('b'), 'B')
+    cache['d'] = 'D'
+    assert 'c' not in cache
+    assert 'a' in cache and 'b' in cache and 'd' in cache
+    self.assertEqual(len(cache), 3)
+    # writing an existing entry refreshes it too
+    cache['a'] = 'A2'
+    cache['e'] = 'E'
+    assert 'b' not in cache
+    self.assertEqual(cache['a'], 'A2')
+    self.assertEqual(cache.get('missing'), None)
+    self.assertEqual(cache.get('missing', 'default'), 'default')
+
+  # Tests the llvm-nm results that are saved across runs, in the cache dir
+  def test_persistent_nm_cache(self):
+    cache_file = os.path.abspath('nm_cache.json')
+    saved = [Building.__dict__[name] for name in ('get_persistent_nm_cache_file', 'is_persistent_nm_candidate', 'PERSISTENT_NM_CACHE_MAX_ENTRIES')]
+
+    def reset():
+      Building.persistent_nm_cache = None
+      Building.persistent_nm_cache_dirty = False
+
+    def add(filename, defs):
+      with open(filename, 'w') as f:
+        f.write(filename)
+      Building.set_persistent_nm(filename, tools.shared.ObjectFileInfo(0, None, frozenset(defs), set(['undef']), frozenset()))
+
+    Building.get_persistent_nm_cache_file = staticmethod(lambda: cache_file)
+    # the files made here live in the temp dir, which is otherwise not saved
+    Building.is_persistent_nm_candidate = staticmethod(lambda filename: True)
+    reset()
+    try:
+      a = os.path.abspath('a.o')
+      add(a, ['a_def'])
+      Building.save_persistent_nm_cache()
+      # a new run reads back what was saved
+      reset()
+      result = Building.get_persistent_nm(a)
+      self.assertEqual(result.defs, frozenset(['a_def']))
+      self.assertEqual(result.undefs, set(['undef']))
+      assert result.is_valid_for_nm()
+
+      # a modified file is not looked up
+      time.sleep(0.1)
+      with open(a, 'a') as f:
+        f.write('more')
+      self.assertEqual(Building.get_persistent_nm(a), None)
+
+      # results from another emscripten or llvm-nm are ignored
+      add(a, ['a_def'])
+      Building.save_persistent_nm_cache()
+      with open(cache_file) as f:
+        data = json.load(f)
+      assert a in data['files']
+      data['tag'][0] = 'another version'
+      with open(cache_file, 'w') as f:
+        json.dump(data, f)
+      reset()
+      self.assertEqual(Building.get_persistent_nm(a), None)
+
+      # past the limit, the least recently used files are dropped when saving
+      try_delete(cache_file)
+      reset()
+      Building.PERSISTENT_NM_CACHE_MAX_ENTRIES = 2
+      for name in ['x.o', 'y.o', 'z.o']:
+        add(os.path.abspath(name), [name])
+        time.sleep(0.01)
+      Building.save_persistent_nm_cache()
+      with open(cache_file) as f:
+        files = json.load(f)['files']
+      self.assertEqual(sorted(files), sorted([os.path.abspath('y.o'), os.path.abspath('z.o')]))
+    finally:
+      Building.get_persistent_nm_cache_file, Building.is_persistent_nm_candidate, Building.PERSISTENT_NM_CACHE_MAX_ENTRIES = saved
+      reset()
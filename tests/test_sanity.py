@@ -1,4 +1,5 @@
 from __future__ import print_function
+import json
 import os
 import platform
 import shutil
@@ -477,6 +478,37 @@ fi
 
     try_delete(CANONICAL_TEMP_DIR)
 
+  # The sanity file records which clang it checked, so that a later run can
+  # tell it is still the same clang without running it again
+  def test_sanity_file_clang_fingerprint(self):
+    restore_and_set_up()
+    output = self.check_working(EMCC)
+    self.assertContained(SANITY_MESSAGE, output)
+    with open(SANITY_FILE) as f:
+      data = json.load(f)
+    clang_stat = os.stat(CLANG)
+    self.assertEqual(data['clang_fingerprint'], [clang_stat.st_mtime, clang_stat.st_size])
+    self.assertEqual(data['clang_version'], get_clang_version())
+    self.assertEqual(data['emscripten_version'], EMSCRIPTEN_VERSION)
+    self.assertEqual(data['llvm_root'], LLVM_ROOT)
+
+    # the recorded version is trusted while the fingerprint matches...
+    previous = dict(data, clang_version='0.0')
+    self.assertEqual(json.loads(generate_sanity(previous))['clang_version'], '0.0')
+    # ...but not once clang has changed
+    previous['clang_fingerprint'] = [0, 0]
+    self.assertEqual(json.loads(generate_sanity(previous))['clang_version'], get_clang_version())
+
+    # a sanity file for another clang makes emcc check again
+    with open(SANITY_FILE, 'w') as f:
+      f.write(json.dumps(dict(data, clang_fingerprint=[0, 0]), sort_keys=True))
+    output = self.check_working(EMCC)
+    self.assertContained(SANITY_MESSAGE, output)
+    with open(SANITY_FILE) as f:
+      self.assertEqual(json.load(f), data)
+    output = self.check_working(EMCC)
+    self.assertNotContained(SANITY_MESSAGE, output)
+
   def test_emcc_caching(self):
     INCLUDING_MESSAGE = 'including X'
     BUILDING_MESSAGE = 'building X for cache'
@@ -21,17 +21,17 @@ class AsmModule():
 
     # heap initializer
     try:
-      self.staticbump = int(re.search(shared.JS.memory_staticbump_pattern, self.pre_js).group(1))
+      self.staticbump = int(shared.JS.memory_staticbump_pattern.search(self.pre_js).group(1))
     except:
       self.staticbump = 0
     if self.staticbump:
       try:
-        self.mem_init_js = re.search(shared.JS.memory_initializer_pattern, self.pre_js).group(0)
+        self.mem_init_js = shared.JS.memory_initializer_pattern.search(self.pre_js).group(0)
       except:
         self.mem_init_js = ''
 
     # global initializers
-    global_inits = re.search(shared.JS.global_initializers_pattern, self.pre_js)
+    global_inits = shared.JS.global_initializers_pattern.search(self.pre_js)
     if global_inits:
       self.global_inits_js = global_inits.group(0)
       self.global_inits = [init.split('{')[2][1:].split('(')[0] for init in global_inits.groups(0)[0].split(',')]
@@ -84,7 +84,7 @@ class AsmModule():
   def set_pre_js(self, staticbump=None, js=None):
     if staticbump is None: staticbump = self.staticbump
     if js is None: js = self.mem_init_js
-    self.pre_js = re.sub(shared.JS.memory_staticbump_pattern, 'STATICTOP = STATIC_BASE + %d;\n' % (staticbump,) + js, self.pre_js, count=1)
+    self.pre_js = shared.JS.memory_staticbump_pattern.sub('STATICTOP = STATIC_BASE + %d;\n' % (staticbump,) + js, self.pre_js, count=1)
 
   def relocate_into(self, main):
     # heap initializer
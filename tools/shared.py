@@ -1,21 +1,30 @@
 from __future__ import print_function
 
-from distutils.spawn import find_executable
 from subprocess import PIPE, STDOUT
+import ast
 import atexit
 import base64
+import collections
+import copy
+import functools
+import hashlib
 import json
 import logging
-import math
+import mmap
 import multiprocessing
+import multiprocessing.pool
+import operator
 import os
 import re
 import shlex
 import shutil
+import stat
 import subprocess
 import sys
 import tempfile
+import threading
 import time
+import zlib
 
 from .toolchain_profiler import ToolchainProfiler
 from .tempfiles import try_delete
@@ -64,7 +73,7 @@ class WindowsPopen(object):
     self.stderr_ = stderr
 
     # If the caller wants one of these PIPEd, we must PIPE them all to avoid the 'handle is invalid' bug.
-    if self.stdin_ == PIPE or self.stdout_ == PIPE or self.stderr_ == PIPE:
+    if self.stdin_ is PIPE or self.stdout_ is PIPE or self.stderr_ is PIPE:
       if self.stdin_ is None:
         self.stdin_ = PIPE
       if self.stdout_ is None:
@@ -91,9 +100,10 @@ class WindowsPopen(object):
     self.returncode = self.process.returncode
 
     # If caller never wanted to PIPE stdout or stderr, route the output back to screen to avoid swallowing output.
-    if self.stdout is None and self.stdout_ == PIPE and len(output[0].strip()):
+    # (isspace() stops at the first non-whitespace character, unlike strip() which copies the whole output.)
+    if self.stdout is None and self.stdout_ is PIPE and output[0] and not output[0].isspace():
       print(output[0], file=sys.stdout)
-    if self.stderr is None and self.stderr_ == PIPE and len(output[1].strip()):
+    if self.stderr is None and self.stderr_ is PIPE and output[1] and not output[1].isspace():
       print(output[1], file=sys.stderr)
 
     # Return a mock object to the caller. This works as long as all emscripten code immediately .communicate()s the result, and doesn't
@@ -117,6 +127,21 @@ def path_from_root(*pathelems):
   return os.path.join(__rootpath__, *pathelems)
 
 
+def memoize(func):
+  """Caches the results of a function of hashable positional arguments, so it
+  only runs once per distinct set of arguments. (functools.lru_cache is not
+  available in Python 2.)"""
+  results = {}
+
+  @functools.wraps(func)
+  def helper(*args):
+    if args not in results:
+      results[args] = func(*args)
+    return results[args]
+
+  return helper
+
+
 # This is a workaround for https://bugs.python.org/issue9400
 class Py2CalledProcessError(subprocess.CalledProcessError):
   def __init__(self, returncode, cmd, output=None, stderr=None):
@@ -138,39 +163,68 @@ class Py2CompletedProcess:
   def __repr__(self):
     _repr = ['args=%s, returncode=%s' % (self.args, self.returncode)]
     if self.stdout is not None:
-      _repr += 'stdout=' + repr(self.stdout)
+      _repr.append('stdout=' + repr(self.stdout))
     if self.stderr is not None:
-      _repr += 'stderr=' + repr(self.stderr)
+      _repr.append('stderr=' + repr(self.stderr))
     return 'CompletedProcess(%s)' % ', '.join(_repr)
 
   def check_returncode(self):
-    if self.returncode is not 0:
+    if self.returncode != 0:
       raise Py2CalledProcessError(returncode=self.returncode, cmd=self.args, output=self.stdout, stderr=self.stderr)
 
 
-def run_base(cmd, check=False, input=None, *args, **kw):
-  if hasattr(subprocess, "run"):
+# Pick the implementation once here rather than checking for subprocess.run
+# on every call.
+if hasattr(subprocess, 'run'):
+  def run_base(cmd, check=False, input=None, *args, **kw):
     return subprocess.run(cmd, check=check, input=input, *args, **kw)
-
-  # Python 2 compatibility: Introduce Python 3 subprocess.run-like behavior
-  if input is not None:
-    kw['stdin'] = subprocess.PIPE
-  proc = Popen(cmd, *args, **kw)
-  stdout, stderr = proc.communicate(input)
-  result = Py2CompletedProcess(cmd, proc.returncode, stdout, stderr)
-  if check:
-    result.check_returncode()
-  return result
+else:
+  def run_base(cmd, check=False, input=None, *args, **kw):
+    # Python 2 compatibility: Introduce Python 3 subprocess.run-like behavior
+    if input is not None:
+      kw['stdin'] = subprocess.PIPE
+    proc = Popen(cmd, *args, **kw)
+    stdout, stderr = proc.communicate(input)
+    result = Py2CompletedProcess(cmd, proc.returncode, stdout, stderr)
+    if check:
+      result.check_returncode()
+    return result
 
 
 def run_process(cmd, universal_newlines=True, check=True, *args, **kw):
   return run_base(cmd, universal_newlines=universal_newlines, check=check, *args, **kw)
 
 
+# Results of tool probes such as `clang -v` or `node --version`, keyed on the
+# command line and the mtime of the executable. The same probes are run many
+# times (e.g. during sanity checks), and each one costs a process spawn.
+_probe_cache = {}
+
+
+def cached_probe(cmd, **kw):
+  """Like run_process, but memoizes the result for as long as the executable
+  being run is not modified. A failure is memoized too, and raised again."""
+  try:
+    mtime = os.stat(cmd[0]).st_mtime
+  except OSError:
+    mtime = None # not a path (e.g. found in PATH); key on the command alone
+  key = (tuple(cmd), mtime, tuple(sorted(kw.items())))
+  if key not in _probe_cache:
+    try:
+      _probe_cache[key] = (True, run_process(cmd, **kw))
+    except Exception as e:
+      _probe_cache[key] = (False, e)
+  ok, result = _probe_cache[key]
+  if not ok:
+    raise result
+  return result
+
+
 def check_execute(cmd, *args, **kw):
   try:
     run_process(cmd, stdout=PIPE, *args, **kw)
-    logging.debug("Successfuly executed %s" % " ".join(cmd))
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+      logging.debug('Successfully executed %s', ' '.join(cmd))
   except subprocess.CalledProcessError as e:
     raise FatalError("'%s' failed with output:\n%s" % (" ".join(e.cmd), e.output))
 
@@ -178,29 +232,92 @@ def check_execute(cmd, *args, **kw):
 def check_call(cmd, *args, **kw):
   try:
     run_process(cmd, *args, **kw)
-    logging.debug("Successfully executed %s" % " ".join(cmd))
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+      logging.debug('Successfully executed %s', ' '.join(cmd))
   except subprocess.CalledProcessError:
     raise FatalError("'%s' failed" % " ".join(cmd))
 
 
+# Maps file names in PATH to where they are first found, see scan_path()
+_path_index = (None, None)
+
+# Where os.scandir exists (Python 3.5+), the directory entries already tell us
+# which names are files, usually without a stat each, so the index only holds
+# files. Otherwise it holds every name, and hits still need an isfile().
+PATH_INDEX_HOLDS_ONLY_FILES = hasattr(os, 'scandir')
+
+
+def scan_path():
+  """Returns a dict from the names of the files in the directories in PATH to
+  (position in PATH, full path) of the first one found. Names are normcase'd,
+  so lookups are case-insensitive where the filesystem is. Listing each
+  directory once is cheaper than probing every directory for every executable
+  we look for. The index is rebuilt when PATH changes, but not when the
+  directories do, so a miss does not prove that a name is absent."""
+  global _path_index
+  path = os.environ.get('PATH', os.defpath)
+  if _path_index[0] != path:
+    index = {}
+    for i, d in enumerate(path.split(os.pathsep)):
+      d = d.strip('"')
+      try:
+        if PATH_INDEX_HOLDS_ONLY_FILES:
+          names = [entry.name for entry in os.scandir(d) if entry.is_file()]
+        else:
+          names = os.listdir(d)
+      except OSError:
+        continue
+      for name in names:
+        index.setdefault(os.path.normcase(name), (i, os.path.join(d, name)))
+    _path_index = (path, index)
+  return _path_index[1]
+
+
+def path_lookup(names):
+  """Returns the full path of the first of the given names in the PATH index,
+  preferring earlier PATH entries and then earlier names, or None."""
+  index = scan_path()
+  best = None
+  for rank, name in enumerate(names):
+    hit = index.get(os.path.normcase(name))
+    if hit and (best is None or (hit[0], rank) < best[0]):
+      best = ((hit[0], rank), hit[1])
+  return best[1] if best else None
+
+
+def find_executable(name):
+  names = [name]
+  if WINDOWS:
+    names.append(name + '.exe')
+  exe = path_lookup(names)
+  if exe and os.path.isfile(exe):
+    return exe
+  return None
+
+
+# Matches the quoted '{{{ NAME }}}' placeholders in settings_template_readonly.py
+CONFIG_TEMPLATE_PLACEHOLDER = re.compile(r"'\{\{\{ (\w+) \}\}\}'")
+
+
 def generate_config(path, first_time=False):
   # Note: repr is used to ensure the paths are escaped correctly on Windows.
   # The full string is replaced so that the template stays valid Python.
-  config_file = open(path_from_root('tools', 'settings_template_readonly.py')).read().split('\n')
-  config_file = config_file[1:] # remove "this file will be copied..."
-  config_file = '\n'.join(config_file)
+  with open(path_from_root('tools', 'settings_template_readonly.py')) as f:
+    config_file = f.read().split('\n', 1)[1] # remove "this file will be copied..."
   # autodetect some default paths
-  config_file = config_file.replace('\'{{{ EMSCRIPTEN_ROOT }}}\'', repr(__rootpath__))
   llvm_root = os.path.dirname(find_executable('llvm-dis') or '/usr/bin/llvm-dis')
-  config_file = config_file.replace('\'{{{ LLVM_ROOT }}}\'', repr(llvm_root))
-
   node = find_executable('nodejs') or find_executable('node') or 'node'
-  config_file = config_file.replace('\'{{{ NODE }}}\'', repr(node))
   if WINDOWS:
     tempdir = os.environ.get('TEMP') or os.environ.get('TMP') or 'c:\\temp'
   else:
     tempdir = '/tmp'
-  config_file = config_file.replace('\'{{{ TEMP }}}\'', repr(tempdir))
+  values = {
+    'EMSCRIPTEN_ROOT': __rootpath__,
+    'LLVM_ROOT': llvm_root,
+    'NODE': node,
+    'TEMP': tempdir,
+  }
+  config_file = CONFIG_TEMPLATE_PLACEHOLDER.sub(lambda m: repr(values[m.group(1)]), config_file)
 
   abspath = os.path.abspath(os.path.expanduser(path))
   # write
@@ -234,18 +351,10 @@ This command will now exit. When you are done editing those paths, re-run it.
 # file that contains the required definitions.
 
 try:
-  EM_CONFIG = sys.argv[sys.argv.index('--em-config') + 1]
-  # And now remove it from sys.argv
-  skip = False
-  newargs = []
-  for arg in sys.argv:
-    if not skip and arg != '--em-config':
-      newargs += [arg]
-    elif arg == '--em-config':
-      skip = True
-    elif skip:
-      skip = False
-  sys.argv = newargs
+  em_config_index = sys.argv.index('--em-config')
+  EM_CONFIG = sys.argv[em_config_index + 1]
+  # And now remove it and its argument from sys.argv
+  del sys.argv[em_config_index:em_config_index + 2]
   # Emscripten compiler spawns other processes, which can reimport shared.py, so make sure that
   # those child processes get the same configuration file by setting it to the currently active environment.
   os.environ['EM_CONFIG'] = EM_CONFIG
@@ -267,7 +376,7 @@ if '\n' in EM_CONFIG:
   logging.debug('EM_CONFIG is specified inline without a file')
 else:
   CONFIG_FILE = os.path.expanduser(EM_CONFIG)
-  logging.debug('EM_CONFIG is located in ' + CONFIG_FILE)
+  logging.debug('EM_CONFIG is located in %s', CONFIG_FILE)
   if not os.path.exists(CONFIG_FILE):
     generate_config(EM_CONFIG, first_time=True)
     sys.exit(0)
@@ -289,9 +398,40 @@ PYTHON = None
 JS_ENGINE = None
 COMPILER_OPTS = []
 
+CONFIG_ASSIGNMENT_KEY = re.compile(r'^[A-Za-z_]\w*$')
+
+
+def parse_config_literals(config_text):
+  """Parses a config made only of `KEY = <literal>` lines (plus comments and
+  blank lines) without executing it. Returns None if the config uses anything
+  else, such as imports or expressions, in which case it must be exec'd."""
+  values = {}
+  for line in config_text.splitlines():
+    line = line.strip()
+    if not line or line.startswith('#'):
+      continue
+    key, sep, value = line.partition('=')
+    key = key.strip()
+    if not sep or not CONFIG_ASSIGNMENT_KEY.match(key):
+      return None
+    try:
+      values[key] = ast.literal_eval(value.strip())
+    except (ValueError, SyntaxError):
+      return None
+  return values
+
+
 try:
-  config_text = open(CONFIG_FILE, 'r').read() if CONFIG_FILE else EM_CONFIG
-  exec(config_text)
+  if CONFIG_FILE:
+    with open(CONFIG_FILE, 'r') as f:
+      config_text = f.read()
+  else:
+    config_text = EM_CONFIG
+  config_values = parse_config_literals(config_text)
+  if config_values is not None:
+    globals().update(config_values)
+  else:
+    exec(config_text)
 except Exception as e:
   logging.error('Error in evaluating %s (at %s): %s, text: %s' % (EM_CONFIG, CONFIG_FILE, str(e), config_text))
   sys.exit(1)
@@ -320,19 +460,33 @@ def listify(x):
   return x
 
 
+# Given a list of (old, new) pairs, replaces each engine in JS_ENGINES that
+# equals an old engine with the corresponding new one, and makes sure all of
+# them are in list form, in a single pass over JS_ENGINES.
+def fix_js_engines(replacements):
+  global JS_ENGINES
+  replacements = [(old, new) for old, new in replacements if old is not None]
+
+  def fix(engine):
+    for old, new in replacements:
+      if engine == old:
+        return new
+    return engine
+
+  JS_ENGINES = [listify(fix(engine)) for engine in JS_ENGINES]
+
+
 def fix_js_engine(old, new):
   if old is None:
     return
-  global JS_ENGINES
-  JS_ENGINES = [new if x == old else x for x in JS_ENGINES]
+  fix_js_engines([(old, new)])
   return new
 
 
-SPIDERMONKEY_ENGINE = fix_js_engine(SPIDERMONKEY_ENGINE, listify(SPIDERMONKEY_ENGINE))
-NODE_JS = fix_js_engine(NODE_JS, listify(NODE_JS))
-V8_ENGINE = fix_js_engine(V8_ENGINE, listify(V8_ENGINE))
+configured_engines = [SPIDERMONKEY_ENGINE, NODE_JS, V8_ENGINE]
+SPIDERMONKEY_ENGINE, NODE_JS, V8_ENGINE = [listify(e) if e is not None else None for e in configured_engines]
+fix_js_engines(zip(configured_engines, [SPIDERMONKEY_ENGINE, NODE_JS, V8_ENGINE]))
 COMPILER_ENGINE = listify(COMPILER_ENGINE)
-JS_ENGINES = [listify(engine) for engine in JS_ENGINES]
 
 if EM_POPEN_WORKAROUND is None:
   EM_POPEN_WORKAROUND = os.environ.get('EM_POPEN_WORKAROUND')
@@ -359,9 +513,13 @@ EM_BUILD_VERBOSE_LEVEL = int(os.getenv('EM_BUILD_VERBOSE', '0'))
 
 # Expectations
 
-actual_clang_version = None
+# The version probes below keep their output as bytes (universal_newlines=False)
+# and only decode the parts they need.
+CLANG_VERSION_PATTERN = re.compile(br'[Vv]ersion\s+(\d+\.\d+)')
+NODE_VERSION_PATTERN = re.compile(br'v?(\d+)\.(\d+)\.(\d+)')
 
 
+@memoize
 def expected_llvm_version():
   if get_llvm_target() == WASM_TARGET:
     return "7.0"
@@ -369,13 +527,11 @@ def expected_llvm_version():
     return "6.0"
 
 
+@memoize
 def get_clang_version():
-  global actual_clang_version
-  if actual_clang_version is None:
-    response = run_process([CLANG, '-v'], stderr=PIPE).stderr
-    m = re.search(r'[Vv]ersion\s+(\d+\.\d+)', response)
-    actual_clang_version = m and m.group(1)
-  return actual_clang_version
+  response = cached_probe([CLANG, '-v'], stderr=PIPE, universal_newlines=False).stderr
+  m = CLANG_VERSION_PATTERN.search(response)
+  return m and asstr(m.group(1))
 
 
 def check_clang_version():
@@ -412,11 +568,31 @@ def get_fastcomp_src_dir():
   return None
 
 
+# the (llvm, clang) versions recorded in the fastcomp source tree, or None if
+# there is no source tree to look in
+def get_fastcomp_repo_versions():
+  d = get_fastcomp_src_dir()
+  if d is None:
+    return None
+  llvm_version = get_emscripten_version(os.path.join(d, 'emscripten-version.txt'))
+  if os.path.exists(os.path.join(d, 'tools', 'clang', 'emscripten-version.txt')):
+    clang_version = get_emscripten_version(os.path.join(d, 'tools', 'clang', 'emscripten-version.txt'))
+  elif os.path.exists(os.path.join(d, 'tools', 'clang')):
+    clang_version = '?' # Looks like the LLVM compiler tree has an old checkout from the time before it contained a version.txt: Should update!
+  else:
+    clang_version = llvm_version # This LLVM compiler tree does not have a tools/clang, so it's probably an out-of-source build directory. No need for separate versioning.
+  return llvm_version, clang_version
+
+
+def fastcomp_repo_versions_match(repo_versions):
+  return repo_versions is None or all(v == EMSCRIPTEN_VERSION for v in repo_versions)
+
+
 def get_llc_targets():
   try:
-    llc_version_info = run_process([LLVM_COMPILER, '--version'], stdout=PIPE).stdout
-    pre, targets = llc_version_info.split('Registered Targets:')
-    return targets
+    llc_version_info = cached_probe([LLVM_COMPILER, '--version'], stdout=PIPE, universal_newlines=False).stdout
+    pre, targets = llc_version_info.split(b'Registered Targets:')
+    return asstr(targets)
   except Exception as e:
     return '(no targets could be identified: ' + str(e) + ')'
 
@@ -450,17 +626,11 @@ def check_fastcomp():
 
     if not Settings.WASM_BACKEND:
       # check repo versions
-      d = get_fastcomp_src_dir()
+      repo_versions = get_fastcomp_repo_versions()
       shown_repo_version_error = False
-      if d is not None:
-        llvm_version = get_emscripten_version(os.path.join(d, 'emscripten-version.txt'))
-        if os.path.exists(os.path.join(d, 'tools', 'clang', 'emscripten-version.txt')):
-          clang_version = get_emscripten_version(os.path.join(d, 'tools', 'clang', 'emscripten-version.txt'))
-        elif os.path.exists(os.path.join(d, 'tools', 'clang')):
-          clang_version = '?' # Looks like the LLVM compiler tree has an old checkout from the time before it contained a version.txt: Should update!
-        else:
-          clang_version = llvm_version # This LLVM compiler tree does not have a tools/clang, so it's probably an out-of-source build directory. No need for separate versioning.
-        if EMSCRIPTEN_VERSION != llvm_version or EMSCRIPTEN_VERSION != clang_version:
+      if repo_versions is not None:
+        llvm_version, clang_version = repo_versions
+        if not fastcomp_repo_versions_match(repo_versions):
           logging.error('Emscripten, llvm and clang repo versions do not match, this is dangerous (%s, %s, %s)', EMSCRIPTEN_VERSION, llvm_version, clang_version)
           logging.error('Make sure to use the same branch in each repo, and to be up-to-date on each. See http://kripken.github.io/emscripten-site/docs/building_from_source/LLVM-Backend.html')
           shown_repo_version_error = True
@@ -469,8 +639,8 @@ def check_fastcomp():
 
       # check build versions. don't show it if the repos are wrong, user should fix that first
       if not shown_repo_version_error:
-        clang_v = run_process([CLANG, '--version'], stdout=PIPE).stdout
-        llvm_build_version, clang_build_version = clang_v.split('(emscripten ')[1].split(')')[0].split(' : ')
+        clang_v = cached_probe([CLANG, '--version'], stdout=PIPE, universal_newlines=False).stdout
+        llvm_build_version, clang_build_version = [asstr(v) for v in clang_v.split(b'(emscripten ')[1].split(b')')[0].split(b' : ')]
         if EMSCRIPTEN_VERSION != llvm_build_version or EMSCRIPTEN_VERSION != clang_build_version:
           logging.error('Emscripten, llvm and clang build versions do not match, this is dangerous (%s, %s, %s)', EMSCRIPTEN_VERSION, llvm_build_version, clang_build_version)
           logging.error('Make sure to rebuild llvm and clang after updating repos')
@@ -487,8 +657,9 @@ EXPECTED_NODE_VERSION = (4, 1, 1)
 def check_node_version():
   jsrun.check_engine(NODE_JS)
   try:
-    actual = run_process(NODE_JS + ['--version'], stdout=PIPE).stdout.strip()
-    version = tuple(map(int, actual.replace('v', '').replace('-pre', '').split('.')))
+    actual = cached_probe(NODE_JS + ['--version'], stdout=PIPE, universal_newlines=False).stdout.strip()
+    version = tuple(map(int, NODE_VERSION_PATTERN.match(actual).groups()))
+    actual = asstr(actual)
     if version >= EXPECTED_NODE_VERSION:
       return True
     logging.warning('node version appears too old (seeing "%s", expected "%s")' % (actual, 'v' + ('.'.join(map(str, EXPECTED_NODE_VERSION)))))
@@ -500,7 +671,7 @@ def check_node_version():
 
 def check_closure_compiler():
   try:
-    run_process([JAVA, '-version'], stdout=PIPE, stderr=PIPE)
+    cached_probe([JAVA, '-version'], stdout=PIPE, stderr=PIPE, universal_newlines=False)
   except:
     logging.warning('java does not seem to exist, required for closure compiler, which is optional (define JAVA in ' + hint_config_file_location() + ' if you want it)')
     return False
@@ -510,6 +681,52 @@ def check_closure_compiler():
   return True
 
 
+def prefetch_sanity_probes():
+  """Runs the subprocesses that the sanity checks in check_sanity() are going
+  to need in parallel.
+
+  The probes are memoized, so the checks that follow find their results ready,
+  and can still report any problems one at a time and in order. Only the
+  probes that those checks will issue are run here (short of a check failing
+  and ending them early), so this never spawns more processes than they would."""
+  # check_llvm_version and check_node_version
+  probes = [
+    lambda: cached_probe([CLANG, '-v'], stderr=PIPE, universal_newlines=False),
+    lambda: jsrun.check_engine(NODE_JS),
+    lambda: cached_probe(NODE_JS + ['--version'], stdout=PIPE, universal_newlines=False),
+  ]
+  if os.environ.get('EMCC_FAST_COMPILER') != '0':
+    # check_fastcomp; clang --version is only looked at for fastcomp, once the
+    # repo versions are known to be right
+    probes.append(lambda: cached_probe([LLVM_COMPILER, '--version'], stdout=PIPE, universal_newlines=False))
+    try:
+      need_clang_version = not Settings.WASM_BACKEND and fastcomp_repo_versions_match(get_fastcomp_repo_versions())
+    except Exception:
+      need_clang_version = False # check_fastcomp will stop at the same error
+    if need_clang_version:
+      probes.append(lambda: cached_probe([CLANG, '--version'], stdout=PIPE, universal_newlines=False))
+    # the checks that EM_IGNORE_SANITY skips
+    if not os.environ.get('EM_IGNORE_SANITY'):
+      # check_engine remembers engines by path, so one probe covers both if they are the same
+      if not (NODE_JS and COMPILER_ENGINE and COMPILER_ENGINE[0] == NODE_JS[0]):
+        probes.append(lambda: jsrun.check_engine(COMPILER_ENGINE))
+      probes.append(lambda: cached_probe([JAVA, '-version'], stdout=PIPE, stderr=PIPE, universal_newlines=False))
+
+  def run(probe):
+    try:
+      probe()
+    except Exception:
+      pass # failures are reported by the check that needs the probe
+
+  # these are all spent waiting on subprocesses, so threads are enough
+  pool = multiprocessing.pool.ThreadPool(len(probes))
+  try:
+    pool.map(run, probes)
+  finally:
+    pool.close()
+    pool.join()
+
+
 # Finds the system temp directory without resorting to using the one configured in .emscripten
 def find_temp_directory():
   if WINDOWS:
@@ -526,7 +743,8 @@ def find_temp_directory():
 
 
 def get_emscripten_version(path):
-  return open(path).read().strip().replace('"', '')
+  with open(path) as f:
+    return f.read().strip().replace('"', '')
 
 
 EMSCRIPTEN_VERSION = get_emscripten_version(path_from_root('emscripten-version.txt'))
@@ -534,8 +752,25 @@ parts = [int(x) for x in EMSCRIPTEN_VERSION.split('.')]
 EMSCRIPTEN_VERSION_MAJOR, EMSCRIPTEN_VERSION_MINOR, EMSCRIPTEN_VERSION_TINY = parts
 
 
-def generate_sanity():
-  return EMSCRIPTEN_VERSION + '|' + LLVM_ROOT + '|' + get_clang_version() + ('_wasm' if Settings.WASM_BACKEND else '')
+def generate_sanity(previous=None):
+  """Returns the contents of the sanity file for the current setup.
+
+  If |previous| (the parsed contents of an existing sanity file) describes the
+  same clang binary as the one we have now, its recorded clang version is reused
+  instead of running clang again to find it."""
+  clang_stat = os.stat(CLANG)
+  clang_fingerprint = [clang_stat.st_mtime, clang_stat.st_size]
+  if isinstance(previous, dict) and previous.get('clang_fingerprint') == clang_fingerprint:
+    clang_version = previous.get('clang_version')
+  else:
+    clang_version = get_clang_version()
+  return json.dumps({
+    'emscripten_version': EMSCRIPTEN_VERSION,
+    'llvm_root': LLVM_ROOT,
+    'clang_fingerprint': clang_fingerprint,
+    'clang_version': clang_version,
+    'wasm_backend': bool(Settings.WASM_BACKEND),
+  }, sort_keys=True)
 
 
 def check_sanity(force=False):
@@ -558,15 +793,24 @@ def check_sanity(force=False):
       sanity_file = CONFIG_FILE + '_sanity'
       if Settings.WASM_BACKEND:
         sanity_file += '_wasm'
-      if os.path.exists(sanity_file):
+      try:
+        sanity_mtime = os.stat(sanity_file).st_mtime
+      except OSError:
+        sanity_mtime = None # no sanity file yet
+      if sanity_mtime is not None:
         try:
-          sanity_mtime = os.stat(sanity_file).st_mtime
           if sanity_mtime <= settings_mtime:
             reason = 'settings file has changed'
           else:
-            sanity_data = open(sanity_file).read().rstrip('\n\r') # workaround weird bug with read() that appends new line char in some old python version
-            if sanity_data != generate_sanity():
-              reason = 'system change: %s vs %s' % (generate_sanity(), sanity_data)
+            with open(sanity_file) as f:
+              sanity_data = f.read().rstrip('\n\r') # workaround weird bug with read() that appends new line char in some old python version
+            try:
+              previous = json.loads(sanity_data)
+            except ValueError:
+              previous = None
+            expected = generate_sanity(previous)
+            if sanity_data != expected:
+              reason = 'system change: %s vs %s' % (expected, sanity_data)
             else:
               if not force:
                 return # all is well
@@ -577,6 +821,8 @@ def check_sanity(force=False):
       Cache.erase()
       force = False # the check actually failed, so definitely write out the sanity file, to avoid others later seeing failures too
 
+    prefetch_sanity_probes()
+
     # some warning, mostly not fatal checks - do them even if EM_IGNORE_SANITY is on
     check_llvm_version()
     check_node_version()
@@ -598,11 +844,21 @@ def check_sanity(force=False):
         exit_with_error('The JavaScript shell used for compiling (%s) does not seem to work, check the paths in %s', COMPILER_ENGINE, EM_CONFIG)
 
     with ToolchainProfiler.profile_block('sanity LLVM'):
+      # the tools normally all live in LLVM_ROOT, so list each directory once
+      # instead of probing for every tool separately
+      dir_contents = {}
       for cmd in [CLANG, LLVM_LINK, LLVM_AR, LLVM_OPT, LLVM_AS, LLVM_DIS, LLVM_NM, LLVM_INTERPRETER]:
-        if not os.path.exists(cmd) and not os.path.exists(cmd + '.exe'):  # .exe extension required for Windows
+        dirname, basename = os.path.split(os.path.normcase(cmd))
+        if dirname not in dir_contents:
+          try:
+            dir_contents[dirname] = set(os.path.normcase(name) for name in os.listdir(dirname or '.'))
+          except OSError:
+            dir_contents[dirname] = set()
+        present = dir_contents[dirname]
+        if basename not in present and basename + '.exe' not in present:  # .exe extension required for Windows
           exit_with_error('Cannot find %s, check the paths in %s', cmd, EM_CONFIG)
 
-    if not os.path.exists(PYTHON) and not os.path.exists(cmd + '.exe'):
+    if not os.path.exists(PYTHON) and not os.path.exists(PYTHON + '.exe'):
       try:
         run_process([PYTHON, '--xversion'], stdout=PIPE, stderr=PIPE)
       except:
@@ -618,9 +874,8 @@ def check_sanity(force=False):
 
     if not force:
       # Only create/update this file if the sanity check succeeded, i.e., we got here
-      f = open(sanity_file, 'w')
-      f.write(generate_sanity())
-      f.close()
+      with open(sanity_file, 'w') as f:
+        f.write(generate_sanity())
 
   except Exception as e:
     # Any error here is not worth failing on
@@ -637,32 +892,43 @@ if CLANG_ADD_VERSION is None:
   CLANG_ADD_VERSION = os.getenv('CLANG_ADD_VERSION')
 
 
+# Only a leading ~ is expanded, so expanding the root once covers every tool in it.
+# Normalizing it too (e.g. to native separators on Windows) means the joined tool
+# paths below are already normalized. (An empty root means tools are looked up
+# in PATH, which normpath would turn into '.')
+LLVM_TOOLS_DIR = os.path.expanduser(LLVM_ROOT)
+if LLVM_TOOLS_DIR:
+  LLVM_TOOLS_DIR = os.path.normpath(LLVM_TOOLS_DIR)
+
+
 # Some distributions ship with multiple llvm versions so they add
 # the version to the binaries, cope with that
 def build_llvm_tool_path(tool):
   if LLVM_ADD_VERSION:
-    return os.path.join(LLVM_ROOT, tool + "-" + LLVM_ADD_VERSION)
+    return os.path.join(LLVM_TOOLS_DIR, tool + "-" + LLVM_ADD_VERSION)
   else:
-    return os.path.join(LLVM_ROOT, tool)
+    return os.path.join(LLVM_TOOLS_DIR, tool)
 
 
 # Some distributions ship with multiple clang versions so they add
 # the version to the binaries, cope with that
 def build_clang_tool_path(tool):
   if CLANG_ADD_VERSION:
-    return os.path.join(LLVM_ROOT, tool + "-" + CLANG_ADD_VERSION)
+    return os.path.join(LLVM_TOOLS_DIR, tool + "-" + CLANG_ADD_VERSION)
   else:
-    return os.path.join(LLVM_ROOT, tool)
+    return os.path.join(LLVM_TOOLS_DIR, tool)
 
 
 # Whenever building a native executable for macOS, we must provide the macOS SDK
 # version we want to target.
+@memoize
 def macos_find_native_sdk_path():
   try:
     sdk_root = '/Applications/Xcode.app/Contents/Developer/Platforms/MacOSX.platform/Developer/SDKs'
-    sdks = os.walk(sdk_root).next()[1]
+    # on Python 3 os.walk is based on os.scandir, so this does not stat each entry
+    sdks = next(os.walk(sdk_root))[1]
     sdk_path = os.path.join(sdk_root, sdks[0]) # Just pick first one found, we don't care which one we found.
-    logging.debug('Targeting macOS SDK found at ' + sdk_path)
+    logging.debug('Targeting macOS SDK found at %s', sdk_path)
     return sdk_path
   except:
     logging.warning('Could not find native macOS SDK path to target!')
@@ -670,39 +936,27 @@ def macos_find_native_sdk_path():
 
 
 # These extra args need to be passed to Clang when targeting a native host system executable
-CACHED_CLANG_NATIVE_ARGS = None
-
-
+@memoize
 def get_clang_native_args():
-  global CACHED_CLANG_NATIVE_ARGS
-  if CACHED_CLANG_NATIVE_ARGS is not None:
-    return CACHED_CLANG_NATIVE_ARGS
-  CACHED_CLANG_NATIVE_ARGS = []
   if MACOS:
     sdk_path = macos_find_native_sdk_path()
     if sdk_path:
-      CACHED_CLANG_NATIVE_ARGS = ['-isysroot', macos_find_native_sdk_path()]
+      return ['-isysroot', sdk_path]
   elif os.name == 'nt':
-    CACHED_CLANG_NATIVE_ARGS = ['-DWIN32']
     # TODO: If Windows.h et al. are needed, will need to add something like '-isystemC:/Program Files (x86)/Microsoft SDKs/Windows/v7.1A/Include'.
-  return CACHED_CLANG_NATIVE_ARGS
+    return ['-DWIN32']
+  return []
 
 
 # This environment needs to be present when targeting a native host system executable
-CACHED_CLANG_NATIVE_ENV = None
-
-
+@memoize
 def get_clang_native_env():
-  global CACHED_CLANG_NATIVE_ENV
-  if CACHED_CLANG_NATIVE_ENV is not None:
-    return CACHED_CLANG_NATIVE_ENV
   env = os.environ.copy()
 
   if WINDOWS:
     # If already running in Visual Studio Command Prompt manually, no need to
     # add anything here, so just return.
     if 'VSINSTALLDIR' in env and 'INCLUDE' in env and 'LIB' in env:
-      CACHED_CLANG_NATIVE_ENV = env
       return env
 
     # Guess where VS2015 is installed (VSINSTALLDIR env. var in VS2015 X64 Command Prompt)
@@ -731,55 +985,65 @@ def get_clang_native_env():
     else:
       raise Exception('Unable to detect Program files directory for native Visual Studio build!')
 
+    # List the installed Windows Kits once for the SDK guesses below
+    windows_kits_dir = os.path.join(prog_files_x86, 'Windows Kits')
+    try:
+      windows_kits = set(os.listdir(windows_kits_dir))
+    except OSError:
+      windows_kits = set()
+
     # Guess where Windows 8.1 SDK is located
     if 'WindowsSdkDir' in env:
       windows8_sdk_dir = env['WindowsSdkDir']
-    elif os.path.isdir(os.path.join(prog_files_x86, 'Windows Kits', '8.1')):
-      windows8_sdk_dir = os.path.join(prog_files_x86, 'Windows Kits', '8.1')
-    if not os.path.isdir(windows8_sdk_dir):
+      windows8_sdk_found = os.path.isdir(windows8_sdk_dir)
+    else:
+      windows8_sdk_dir = os.path.join(windows_kits_dir, '8.1')
+      windows8_sdk_found = '8.1' in windows_kits
+    if not windows8_sdk_found:
       raise Exception('Windows 8.1 SDK was not found in "' + windows8_sdk_dir + '"! Run in Visual Studio command prompt to avoid the need to autoguess this location (or set WindowsSdkDir env var).')
 
     # Guess where Windows 10 SDK is located
-    if os.path.isdir(os.path.join(prog_files_x86, 'Windows Kits', '10')):
-      windows10_sdk_dir = os.path.join(prog_files_x86, 'Windows Kits', '10')
-    if not os.path.isdir(windows10_sdk_dir):
+    windows10_sdk_dir = os.path.join(windows_kits_dir, '10')
+    if '10' not in windows_kits:
       raise Exception('Windows 10 SDK was not found in "' + windows10_sdk_dir + '"! Run in Visual Studio command prompt to avoid the need to autoguess this location.')
 
     env.setdefault('VSINSTALLDIR', visual_studio_path)
     env.setdefault('VCINSTALLDIR', os.path.join(visual_studio_path, 'VC'))
 
     windows10sdk_kits_include_dir = os.path.join(windows10_sdk_dir, 'Include')
-    windows10sdk_kit_version_name = [x for x in os.listdir(windows10sdk_kits_include_dir) if os.path.isdir(os.path.join(windows10sdk_kits_include_dir, x))][0] # e.g. "10.0.10150.0" or "10.0.10240.0"
-
-    def append_item(key, item):
-      if key not in env or len(env[key].strip()) == 0:
-        env[key] = item
-      else:
-        env[key] = env[key] + ';' + item
-
-    append_item('INCLUDE', os.path.join(env['VCINSTALLDIR'], 'INCLUDE'))
-    append_item('INCLUDE', os.path.join(env['VCINSTALLDIR'], 'ATLMFC', 'INCLUDE'))
-    append_item('INCLUDE', os.path.join(windows10_sdk_dir, 'include', windows10sdk_kit_version_name, 'ucrt'))
-    #   append_item('INCLUDE', 'C:\\Program Files (x86)\\Windows Kits\\NETFXSDK\\4.6.1\\include\\um') # VS2015 X64 command prompt has this, but not needed for Emscripten
-    append_item('INCLUDE', os.path.join(env['VCINSTALLDIR'], 'ATLMFC', 'INCLUDE'))
-    append_item('INCLUDE', os.path.join(windows8_sdk_dir, 'include', 'shared'))
-    append_item('INCLUDE', os.path.join(windows8_sdk_dir, 'include', 'um'))
-    append_item('INCLUDE', os.path.join(windows8_sdk_dir, 'include', 'winrt'))
-    logging.debug('VS2015 native build INCLUDE: ' + env['INCLUDE'])
-
-    append_item('LIB', os.path.join(env['VCINSTALLDIR'], 'LIB', 'amd64'))
-    append_item('LIB', os.path.join(env['VCINSTALLDIR'], 'ATLMFC', 'LIB', 'amd64'))
-    append_item('LIB', os.path.join(windows10_sdk_dir, 'lib', windows10sdk_kit_version_name, 'ucrt', 'x64'))
-    #   append_item('LIB', 'C:\\Program Files (x86)\\Windows Kits\\NETFXSDK\\4.6.1\\lib\\um\\x64') # VS2015 X64 command prompt has this, but not needed for Emscripten
-    append_item('LIB', os.path.join(windows8_sdk_dir, 'lib', 'winv6.3', 'um', 'x64'))
-    logging.debug('VS2015 native build LIB: ' + env['LIB'])
+    windows10sdk_kit_version_name = next(x for x in os.listdir(windows10sdk_kits_include_dir) if os.path.isdir(os.path.join(windows10sdk_kits_include_dir, x))) # e.g. "10.0.10150.0" or "10.0.10240.0"
+
+    def append_items(key, items):
+      if key in env and len(env[key].strip()):
+        items = [env[key]] + items
+      env[key] = ';'.join(items)
+
+    append_items('INCLUDE', [
+      os.path.join(env['VCINSTALLDIR'], 'INCLUDE'),
+      os.path.join(env['VCINSTALLDIR'], 'ATLMFC', 'INCLUDE'),
+      os.path.join(windows10_sdk_dir, 'include', windows10sdk_kit_version_name, 'ucrt'),
+      # 'C:\\Program Files (x86)\\Windows Kits\\NETFXSDK\\4.6.1\\include\\um', # VS2015 X64 command prompt has this, but not needed for Emscripten
+      os.path.join(env['VCINSTALLDIR'], 'ATLMFC', 'INCLUDE'),
+      os.path.join(windows8_sdk_dir, 'include', 'shared'),
+      os.path.join(windows8_sdk_dir, 'include', 'um'),
+      os.path.join(windows8_sdk_dir, 'include', 'winrt'),
+    ])
+    logging.debug('VS2015 native build INCLUDE: %s', env['INCLUDE'])
+
+    append_items('LIB', [
+      os.path.join(env['VCINSTALLDIR'], 'LIB', 'amd64'),
+      os.path.join(env['VCINSTALLDIR'], 'ATLMFC', 'LIB', 'amd64'),
+      os.path.join(windows10_sdk_dir, 'lib', windows10sdk_kit_version_name, 'ucrt', 'x64'),
+      # 'C:\\Program Files (x86)\\Windows Kits\\NETFXSDK\\4.6.1\\lib\\um\\x64', # VS2015 X64 command prompt has this, but not needed for Emscripten
+      os.path.join(windows8_sdk_dir, 'lib', 'winv6.3', 'um', 'x64'),
+    ])
+    logging.debug('VS2015 native build LIB: %s', env['LIB'])
 
     env['PATH'] = env['PATH'] + ';' + os.path.join(env['VCINSTALLDIR'], 'BIN')
-    logging.debug('VS2015 native build PATH: ' + env['PATH'])
+    logging.debug('VS2015 native build PATH: %s', env['PATH'])
 
   # Current configuration above is all Visual Studio -specific, so on non-Windowses, no action needed.
 
-  CACHED_CLANG_NATIVE_ENV = env
   return env
 
 
@@ -787,19 +1051,19 @@ def exe_suffix(cmd):
   return cmd + '.exe' if WINDOWS else cmd
 
 
-CLANG_CC = os.path.expanduser(build_clang_tool_path(exe_suffix('clang')))
-CLANG_CPP = os.path.expanduser(build_clang_tool_path(exe_suffix('clang++')))
+CLANG_CC = build_clang_tool_path(exe_suffix('clang'))
+CLANG_CPP = build_clang_tool_path(exe_suffix('clang++'))
 CLANG = CLANG_CPP
 LLVM_LINK = build_llvm_tool_path(exe_suffix('llvm-link'))
 LLVM_AR = build_llvm_tool_path(exe_suffix('llvm-ar'))
-LLVM_OPT = os.path.expanduser(build_llvm_tool_path(exe_suffix('opt')))
-LLVM_AS = os.path.expanduser(build_llvm_tool_path(exe_suffix('llvm-as')))
-LLVM_DIS = os.path.expanduser(build_llvm_tool_path(exe_suffix('llvm-dis')))
-LLVM_NM = os.path.expanduser(build_llvm_tool_path(exe_suffix('llvm-nm')))
-LLVM_INTERPRETER = os.path.expanduser(build_llvm_tool_path(exe_suffix('lli')))
-LLVM_COMPILER = os.path.expanduser(build_llvm_tool_path(exe_suffix('llc')))
-LLVM_DWARFDUMP = os.path.expanduser(build_llvm_tool_path(exe_suffix('llvm-dwarfdump')))
-WASM_LD = os.path.expanduser(build_llvm_tool_path(exe_suffix('wasm-ld')))
+LLVM_OPT = build_llvm_tool_path(exe_suffix('opt'))
+LLVM_AS = build_llvm_tool_path(exe_suffix('llvm-as'))
+LLVM_DIS = build_llvm_tool_path(exe_suffix('llvm-dis'))
+LLVM_NM = build_llvm_tool_path(exe_suffix('llvm-nm'))
+LLVM_INTERPRETER = build_llvm_tool_path(exe_suffix('lli'))
+LLVM_COMPILER = build_llvm_tool_path(exe_suffix('llc'))
+LLVM_DWARFDUMP = build_llvm_tool_path(exe_suffix('llvm-dwarfdump'))
+WASM_LD = build_llvm_tool_path(exe_suffix('wasm-ld'))
 
 EMSCRIPTEN = path_from_root('emscripten.py')
 EMCC = path_from_root('emcc.py')
@@ -812,6 +1076,9 @@ EMMAKEN = path_from_root('tools', 'emmaken.py')
 AUTODEBUGGER = path_from_root('tools', 'autodebugger.py')
 EXEC_LLVM = path_from_root('tools', 'exec_llvm.py')
 FILE_PACKAGER = path_from_root('tools', 'file_packager.py')
+PREPROCESSOR = path_from_root('tools', 'preprocessor.js')
+FETCH_WORKER_SRC = path_from_root('src', 'fetch-worker.js')
+SYSTEM_BIN_DIR = path_from_root('system', 'bin')
 
 
 # Temp dir. Create a random one, unless EMCC_DEBUG is set, in which case use TEMP_DIR/emscripten_temp
@@ -830,13 +1097,8 @@ def get_emscripten_temp_dir():
   global configuration, EMSCRIPTEN_TEMP_DIR
   if not EMSCRIPTEN_TEMP_DIR:
     EMSCRIPTEN_TEMP_DIR = tempfile.mkdtemp(prefix='emscripten_temp_', dir=configuration.TEMP_DIR)
-
-    def prepare_to_clean_temp(d):
-      def clean_temp():
-        try_delete(d)
-
-      atexit.register(clean_temp)
-    prepare_to_clean_temp(EMSCRIPTEN_TEMP_DIR) # this global var might change later
+    # bind the current value, as this global var might change later
+    atexit.register(try_delete, EMSCRIPTEN_TEMP_DIR)
   return EMSCRIPTEN_TEMP_DIR
 
 
@@ -865,27 +1127,29 @@ class WarningManager(object):
 
   @staticmethod
   def capture_warnings(cmd_args):
-    for i in range(len(cmd_args)):
-      if not cmd_args[i].startswith('-W'):
+    # returns the args that were not consumed as warning flags
+    remaining_args = []
+    for arg in cmd_args:
+      if not arg.startswith('-W'):
+        remaining_args.append(arg)
         continue
 
       # special case pre-existing warn-absolute-paths
-      if cmd_args[i] == '-Wwarn-absolute-paths':
-        cmd_args[i] = ''
+      if arg == '-Wwarn-absolute-paths':
         WarningManager.warnings['ABSOLUTE_PATHS']['enabled'] = True
-      elif cmd_args[i] == '-Wno-warn-absolute-paths':
-        cmd_args[i] = ''
+      elif arg == '-Wno-warn-absolute-paths':
         WarningManager.warnings['ABSOLUTE_PATHS']['enabled'] = False
       else:
         # convert to string representation of Warning
-        warning_enum = cmd_args[i].replace('-Wno-', '').replace('-W', '')
+        warning_enum = arg.replace('-Wno-', '').replace('-W', '')
         warning_enum = warning_enum.upper().replace('-', '_')
 
         if warning_enum in WarningManager.warnings:
-          WarningManager.warnings[warning_enum]['enabled'] = not cmd_args[i].startswith('-Wno-')
-          cmd_args[i] = ''
+          WarningManager.warnings[warning_enum]['enabled'] = not arg.startswith('-Wno-')
+        else:
+          remaining_args.append(arg)
 
-    return cmd_args
+    return remaining_args
 
   @staticmethod
   def warn(warning_type, message=None):
@@ -911,7 +1175,7 @@ class Configuration(object):
       self.TEMP_DIR = find_temp_directory()
       if self.TEMP_DIR is None:
         logging.critical('TEMP_DIR not defined in ' + hint_config_file_location() + ", and could not detect a suitable directory! Please configure .emscripten to contain a variable TEMP_DIR='/path/to/temp/dir'.")
-      logging.debug('TEMP_DIR not defined in ' + hint_config_file_location() + ', using ' + self.TEMP_DIR)
+      logging.debug('TEMP_DIR not defined in %s, using %s', hint_config_file_location(), self.TEMP_DIR)
 
     if not os.path.isdir(self.TEMP_DIR):
       logging.critical("The temp directory TEMP_DIR='" + self.TEMP_DIR + "' doesn't seem to exist! Please make sure that the path is correct.")
@@ -925,6 +1189,9 @@ class Configuration(object):
       except Exception as e:
         logging.error(str(e) + 'Could not create canonical temp dir. Check definition of TEMP_DIR in ' + hint_config_file_location())
 
+  # Each caller gets its own TempFiles, as callers such as js_optimizer clean
+  # up everything they noted while emcc is still using its own temp files.
+  # The temp dir itself is created only once, by get_emscripten_temp_dir().
   def get_temp_files(self):
     return tempfiles.TempFiles(
       tmp=self.TEMP_DIR if not self.DEBUG else get_emscripten_temp_dir(),
@@ -961,11 +1228,11 @@ if CLOSURE_COMPILER is None:
   CLOSURE_COMPILER = path_from_root('third_party', 'closure-compiler', 'compiler.jar')
 
 if PYTHON is None:
-  logging.debug('PYTHON not defined in ' + hint_config_file_location() + ', using "%s"' % (sys.executable,))
+  logging.debug('PYTHON not defined in %s, using "%s"', hint_config_file_location(), sys.executable)
   PYTHON = sys.executable
 
 if JAVA is None:
-  logging.debug('JAVA not defined in ' + hint_config_file_location() + ', using "java"')
+  logging.debug('JAVA not defined in %s, using "java"', hint_config_file_location())
   JAVA = 'java'
 
 # Additional compiler options
@@ -998,25 +1265,46 @@ def check_vanilla():
 
     def get_vanilla_file():
       saved_file = os.path.join(temp_cache.dirname, 'is_vanilla.txt')
-      open(saved_file, 'w').write(('1' if check_vanilla() else '0') + ':' + LLVM_ROOT)
+      with open(saved_file, 'w') as f:
+        f.write(('1' if check_vanilla() else '0') + ':' + LLVM_ROOT)
       return saved_file
 
-    is_vanilla_file = temp_cache.get('is_vanilla', get_vanilla_file, extension='.txt')
-    if CONFIG_FILE and os.stat(CONFIG_FILE).st_mtime > os.stat(is_vanilla_file).st_mtime:
-      logging.debug('config file changed since we checked vanilla; re-checking')
-      is_vanilla_file = temp_cache.get('is_vanilla', get_vanilla_file, extension='.txt', force=True)
-    try:
-      contents = open(is_vanilla_file).read()
+    def read_vanilla_file(is_vanilla_file):
+      with open(is_vanilla_file) as f:
+        contents = f.read()
       middle = contents.index(':')
-      is_vanilla = int(contents[:middle])
-      llvm_used = contents[middle + 1:]
-      if llvm_used != LLVM_ROOT:
-        logging.debug('regenerating vanilla check since other llvm')
-        temp_cache.get('is_vanilla', get_vanilla_file, extension='.txt', force=True)
+      return int(contents[:middle]), contents[middle + 1:]
+
+    if multiprocessing.current_process().name != 'MainProcess':
+      # A multiprocessing child that was spawned rather than forked (e.g. on
+      # Windows) imports this module before g_multiprocessing_initializer gives
+      # it EMCC_WASM_BACKEND. Its parent may be holding the cache lock while it
+      # waits for us, so read the parent's result without locking, and only run
+      # the check here if that result is missing or out of date.
+      try:
+        is_vanilla_file = os.path.join(temp_cache.dirname, 'is_vanilla.txt')
+        if CONFIG_FILE and os.stat(CONFIG_FILE).st_mtime > os.stat(is_vanilla_file).st_mtime:
+          raise Exception('config file changed since the vanilla check')
+        is_vanilla, llvm_used = read_vanilla_file(is_vanilla_file)
+        if llvm_used != LLVM_ROOT:
+          raise Exception('vanilla check was for other llvm')
+      except Exception as e:
+        logging.debug('failed to use vanilla file, will re-check: %s', e)
+        is_vanilla = check_vanilla()
+    else:
+      is_vanilla_file = temp_cache.get('is_vanilla', get_vanilla_file, extension='.txt')
+      if CONFIG_FILE and os.stat(CONFIG_FILE).st_mtime > os.stat(is_vanilla_file).st_mtime:
+        logging.debug('config file changed since we checked vanilla; re-checking')
+        is_vanilla_file = temp_cache.get('is_vanilla', get_vanilla_file, extension='.txt', force=True)
+      try:
+        is_vanilla, llvm_used = read_vanilla_file(is_vanilla_file)
+        if llvm_used != LLVM_ROOT:
+          logging.debug('regenerating vanilla check since other llvm')
+          # regenerating runs the check, so just read back its result
+          is_vanilla, _ = read_vanilla_file(temp_cache.get('is_vanilla', get_vanilla_file, extension='.txt', force=True))
+      except Exception as e:
+        logging.debug('failed to use vanilla file, will re-check: %s', e)
         is_vanilla = check_vanilla()
-    except Exception as e:
-      logging.debug('failed to use vanilla file, will re-check: ' + str(e))
-      is_vanilla = check_vanilla()
     temp_cache = None
     if is_vanilla:
       logging.debug('check tells us to use wasm backend')
@@ -1106,15 +1394,49 @@ try:
 except NameError:
   pass
 
+
 # If we have 'env', we should use that to find python, because |python| may fail while |env python| may work
 # (For example, if system python is 3.x while we need 2.x, and env gives 2.x if told to do so.)
-ENV_PREFIX = []
-if not WINDOWS:
+# The answer only depends on which python |env| finds, so it is remembered in
+# TEMP_DIR across runs, keyed on that python's path and mtime. If that file can't
+# be used for any reason, we just run the probe.
+def probe_env_python():
   try:
-    assert 'Python' in run_process(['env', 'python', '-V'], stdout=PIPE, stderr=STDOUT).stdout
-    ENV_PREFIX = ['env']
-  except:
-    pass
+    return 'Python' in run_process(['env', 'python', '-V'], stdout=PIPE, stderr=STDOUT).stdout
+  except Exception:
+    return False
+
+
+def get_env_prefix():
+  if WINDOWS:
+    return []
+  python = find_executable('python')
+  if not python or not find_executable('env'):
+    return []
+  try:
+    key = '%s:%s' % (python, os.stat(python).st_mtime)
+  except OSError:
+    return ['env'] if probe_env_python() else []
+  probe_file = os.path.join(TEMP_DIR, 'emscripten_env_python.txt') if TEMP_DIR else None
+  if probe_file:
+    try:
+      with open(probe_file) as f:
+        cached_key, result = f.read().rsplit('\n', 1)
+      if cached_key == key:
+        return ['env'] if result == '1' else []
+    except (IOError, OSError, ValueError):
+      pass
+  found = probe_env_python()
+  if probe_file:
+    try:
+      with open(probe_file, 'w') as f:
+        f.write(key + '\n' + ('1' if found else '0'))
+    except (IOError, OSError):
+      pass
+  return ['env'] if found else []
+
+
+ENV_PREFIX = get_env_prefix()
 
 
 # Utilities
@@ -1138,24 +1460,30 @@ def to_cc(cxx):
 def line_splitter(data):
   """Silly little tool to split JSON arrays over many lines."""
 
-  out = ''
+  # Break after the first space once more than 60 characters have passed since
+  # the last break, working on whole words rather than single characters.
+  words = data.split(' ')
+  out = []
   counter = 0
 
-  for i in range(len(data)):
-    out += data[i]
-    if data[i] == ' ' and counter > 60:
-      out += '\n'
+  for word in words[:-1]:
+    counter += len(word)
+    if counter > 60:
+      out.append(word + ' \n')
       counter = 0
     else:
+      out.append(word + ' ')
       counter += 1
+  out.append(words[-1])
 
-  return out
+  return ''.join(out)
 
 
 def limit_size(string, MAX=800 * 20):
   if len(string) < MAX:
     return string
-  return string[0:MAX / 2] + '\n[..]\n' + string[-MAX / 2:]
+  half = MAX // 2
+  return '%s\n[..]\n%s' % (string[:half], string[-half:])
 
 
 def read_pgo_data(filename):
@@ -1165,20 +1493,24 @@ def read_pgo_data(filename):
   signs_lines = []
   overflows_lines = []
 
-  for line in open(filename, 'r'):
-    try:
-      if line.rstrip() == '':
-        continue
+  with open(filename, 'r') as f:
+    for line in f:
       if '%0 failures' in line:
         continue
-      left, right = line.split(' : ')
-      signature = left.split('|')[1]
+      # skip anything that is not of the form  ...|signature|... : ...
+      # (this includes blank lines)
+      parts = line.split(' : ')
+      if len(parts) != 2:
+        continue
+      left = parts[0]
+      fields = left.split('|')
+      if len(fields) < 2:
+        continue
+      signature = fields[1]
       if 'Sign' in left:
         signs_lines.append(signature)
       elif 'Overflow' in left:
         overflows_lines.append(signature)
-    except:
-      pass
 
   return {
     'signs_lines': signs_lines,
@@ -1190,15 +1522,9 @@ def unique_ordered(values):
   """return a list of unique values in an input list, without changing order
   (list(set(.)) would change order randomly).
   """
+  # (dict.fromkeys would do this too, but dicts are only ordered on Python 3.7+)
   seen = set()
-
-  def check(value):
-    if value in seen:
-      return False
-    seen.add(value)
-    return True
-
-  return list(filter(check, values))
+  return [value for value in values if not (value in seen or seen.add(value))]
 
 
 def expand_response(data):
@@ -1213,16 +1539,25 @@ def expand_byte_size_suffixes(value):
   integer.
   """
   value = value.lower().replace('tb', '*1024*1024*1024*1024').replace('gb', '*1024*1024*1024').replace('mb', '*1024*1024').replace('kb', '*1024').replace('b', '')
+  # the common case is just a product of integers, which needs no eval
+  factors = value.split('*')
+  if all(factor.strip().isdigit() for factor in factors):
+    return functools.reduce(operator.mul, (int(factor) for factor in factors), 1)
   try:
     return eval(value)
   except:
     raise Exception("Invalid byte size, valid suffixes: KB, MB, GB, TB")
 
 
+SETTINGS_VAR_PATTERN = re.compile(r'var ([\w\d]+)')
+SETTING_ASSIGNMENT_PATTERN = re.compile(r'([\w\d]+)\s*=\s*(.+)')
+
+
 # Settings. A global singleton. Not pretty, but nicer than passing |, settings| everywhere
 class SettingsManager(object):
   class __impl(object):
     attrs = {}
+    defaults = None # the parsed contents of settings.js, read only once
 
     def __init__(self):
       self.reset()
@@ -1232,13 +1567,28 @@ class SettingsManager(object):
       self.attrs = {'QUANTUM_SIZE': 4}
       self.load()
 
+    # Values of -s X=Y are nearly always Python literals (numbers, strings, lists),
+    # which do not need to be compiled and run as code.
+    @staticmethod
+    def parse_setting_value(value):
+      try:
+        return ast.literal_eval(value)
+      except (ValueError, SyntaxError):
+        return eval(value)
+
     # Given some emcc-type args (-O3, -s X=Y, etc.), fill Settings with the right settings
     @classmethod
     def load(self, args=[]):
       # Load the JS defaults into python
-      settings = open(path_from_root('src', 'settings.js')).read().replace('//', '#')
-      settings = re.sub(r'var ([\w\d]+)', r'self.attrs["\1"]', settings)
-      exec(settings)
+      if self.defaults is None:
+        with open(path_from_root('src', 'settings.js')) as f:
+          settings = f.read().replace('//', '#')
+        settings = SETTINGS_VAR_PATTERN.sub(r'defaults["\1"]', settings)
+        defaults = {}
+        exec(settings, {'defaults': defaults})
+        self.defaults = defaults
+      # copy, as settings such as lists get modified in place later on
+      self.attrs.update(copy.deepcopy(self.defaults))
 
       # Apply additional settings. First -O, then -s
       for arg in args:
@@ -1252,8 +1602,10 @@ class SettingsManager(object):
           self.apply_opt_level(level, shrink)
       for i in range(len(args)):
         if args[i] == '-s':
-          declare = re.sub(r'([\w\d]+)\s*=\s*(.+)', r'self.attrs["\1"]=\2;', args[i + 1])
-          exec(declare)
+          match = SETTING_ASSIGNMENT_PATTERN.search(args[i + 1])
+          if not match:
+            raise Exception('invalid setting, expected -s KEY=VALUE: ' + args[i + 1])
+          self.attrs[match.group(1)] = self.parse_setting_value(match.group(2))
 
       if get_llvm_target() == WASM_TARGET:
         self.attrs['WASM_BACKEND'] = 1
@@ -1263,11 +1615,21 @@ class SettingsManager(object):
     @classmethod
     def serialize(self):
       ret = []
+      for assignment in self.assignments():
+        ret += ['-s', assignment]
+      return ret
+
+    # Yields each setting as a KEY=VALUE string, with the value in JSON
+    @classmethod
+    def assignments(self):
       for key, value in self.attrs.items():
         if key == key.upper():  # this is a hack. all of our settings are ALL_CAPS, python internals are not
-          jsoned = json.dumps(value, sort_keys=True)
-          ret += ['-s', key + '=' + jsoned]
-      return ret
+          yield key + '=' + json.dumps(value, sort_keys=True)
+
+    # The settings as JS variable declarations, for the JS preprocessor
+    @classmethod
+    def as_js_vars(self):
+      return 'var ' + ';\nvar '.join(self.assignments())
 
     @classmethod
     def to_dict(self):
@@ -1293,10 +1655,11 @@ class SettingsManager(object):
         raise AttributeError
 
     def __setattr__(self, attr, value):
-      if attr not in self.attrs:
+      # looking for suggestions is slow, so only do it if the warning will be shown
+      if attr not in self.attrs and logging.getLogger().isEnabledFor(logging.WARNING):
         import difflib
         logging.warning('''Assigning a non-existent settings attribute "%s"''' % attr)
-        suggestions = ', '.join(difflib.get_close_matches(attr, list(self.attrs.keys())))
+        suggestions = ', '.join(difflib.get_close_matches(attr, self.attrs))
         if suggestions:
           logging.warning(''' - did you mean one of %s?''' % suggestions)
         logging.warning(''' - perhaps a typo in emcc's  -s X=Y  notation?''')
@@ -1362,26 +1725,30 @@ verify_settings()
 def warn_if_duplicate_entries(archive_contents, archive_filename_hint=''):
   if len(archive_contents) != len(set(archive_contents)):
     logging.warning('loading from archive %s, which has duplicate entries (files with identical base names). this is dangerous as only the last will be taken into account, and you may see surprising undefined symbols later. you should rename source files to avoid this problem (or avoid .a archives, and just link bitcode together to form libraries for later linking)' % archive_filename_hint)
-    warned = set()
-    for i in range(len(archive_contents)):
-      curr = archive_contents[i]
-      if curr not in warned and curr in archive_contents[i + 1:]:
+    counts = collections.Counter(archive_contents)
+    # report in order of first appearance, once per name
+    for curr in archive_contents:
+      if counts[curr] > 1:
         logging.warning('   duplicate: %s' % curr)
-        warned.add(curr)
+        counts[curr] = 0
+
+
+# suffix of the temp dirs the archive contents are extracted to
+ARCHIVE_CONTENTS_SUFFIX = '_archive_contents'
 
 
 # N.B. This function creates a temporary directory specified by the 'dir' field in the returned dictionary. Caller
 # is responsible for cleaning up those files after done.
 def extract_archive_contents(f):
   try:
-    cwd = os.getcwd()
-    temp_dir = tempfile.mkdtemp('_archive_contents', 'emscripten_temp_')
+    temp_dir = tempfile.mkdtemp(ARCHIVE_CONTENTS_SUFFIX, 'emscripten_temp_')
     safe_ensure_dirs(temp_dir)
-    os.chdir(temp_dir)
-    contents = [x for x in run_process([LLVM_AR, 't', f], stdout=PIPE).stdout.split('\n') if len(x)]
+    # run llvm-ar in temp_dir rather than chdir'ing there, which would change
+    # the cwd of the whole process
+    contents = [x for x in run_process([LLVM_AR, 't', f], stdout=PIPE, cwd=temp_dir).stdout.split('\n') if len(x)]
     warn_if_duplicate_entries(contents, f)
     if len(contents) == 0:
-      logging.debug('Archive %s appears to be empty (recommendation: link an .so instead of .a)' % f)
+      logging.debug('Archive %s appears to be empty (recommendation: link an .so instead of .a)', f)
       return {
         'returncode': 0,
         'dir': temp_dir,
@@ -1390,13 +1757,14 @@ def extract_archive_contents(f):
 
     # We are about to ask llvm-ar to extract all the files in the .a archive file, but
     # it will silently fail if the directory for the file does not exist, so make all the necessary directories
+    # (which is why we cannot just list the members while extracting them)
     for content in contents:
       dirname = os.path.dirname(content)
       if dirname:
-        safe_ensure_dirs(dirname)
-    proc = run_process([LLVM_AR, 'xo', f], stdout=PIPE, stderr=STDOUT)
+        safe_ensure_dirs(os.path.join(temp_dir, dirname))
+    proc = run_process([LLVM_AR, 'xo', f], stdout=PIPE, stderr=STDOUT, cwd=temp_dir)
     # if absolute paths, files will appear there. otherwise, in this directory
-    contents = [os.path.abspath(c) for c in contents]
+    contents = [os.path.abspath(os.path.join(temp_dir, c)) for c in contents]
     nonexisting_contents = [x for x in contents if not os.path.exists(x)]
     if len(nonexisting_contents):
       raise Exception('llvm-ar failed to extract file(s) ' + str(nonexisting_contents) + ' from archive file ' + f + '! Error:' + str(proc.stdout))
@@ -1408,8 +1776,6 @@ def extract_archive_contents(f):
     }
   except Exception as e:
     print('extract archive contents( ' + str(f) + ') failed with error: ' + str(e), file=sys.stderr)
-  finally:
-    os.chdir(cwd)
 
   return {
     'returncode': 1,
@@ -1418,24 +1784,82 @@ def extract_archive_contents(f):
   }
 
 
+# Extracts several archives at once, in parallel when there is more than one.
+def extract_archive_contents_batch(files):
+  if len(files) <= 1:
+    return [extract_archive_contents(f) for f in files]
+  return Building.get_thread_pool().map(extract_archive_contents, files)
+
+
+# A line of llvm-nm output with a symbol's status and name.
+#  * pnacl-nm will print zero offsets for bitcode, and newer llvm-nm will print present symbols as  -------- T name
+#  * lines with absolute offsets are not matched, these are not bitcode anyhow (e.g. |00000630 t d_source_name|)
+#  * nor are lines with a ':', e.g.  filename.o:  , saying which file it's from
+NM_SYMBOL_PATTERN = re.compile(r'^ *(?:(?:00000000|--------) +)?([^ :\n]+) +([^ :\n]+) *$', re.M)
+
+
 class ObjectFileInfo(object):
-  def __init__(self, returncode, output, defs=set(), undefs=set(), commons=set()):
+  def __init__(self, returncode, output, defs=frozenset(), undefs=None, commons=frozenset()):
     self.returncode = returncode
     self.output = output
     self.defs = defs
-    self.undefs = undefs
+    # undefs may get more symbols added later (see system_libs)
+    self.undefs = undefs if undefs is not None else set()
     self.commons = commons
+    # the symbols this object provides to the link
+    self.provided = defs | commons
 
   def is_valid_for_nm(self):
     return self.returncode == 0
 
 
-# Due to a python pickling issue, the following two functions must be at top
+# A cache of llvm-nm results (ObjectFileInfo by filename) that forgets the oldest
+# entries past a limit, so that long-running processes that link many times (like
+# the test runner) don't keep every result around forever.
+# An llvm-nm results cache that holds at most max_entries files, dropping the
+# least recently used one to make room. (This wraps an OrderedDict instead of
+# subclassing it, as Python 2's OrderedDict uses self[key] internally, e.g. in
+# items(), and reads here reorder it.)
+class NmCache(object):
+  def __init__(self, max_entries=5000):
+    self.max_entries = max_entries
+    self.entries = collections.OrderedDict()
+
+  def __contains__(self, key):
+    return key in self.entries
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __getitem__(self, key):
+    # move the entry to the end, which is where the most recently used ones are
+    # (OrderedDict.move_to_end does this, but is Python 3 only)
+    value = self.entries.pop(key)
+    self.entries[key] = value
+    return value
+
+  def get(self, key, default=None):
+    if key in self.entries:
+      return self[key]
+    return default
+
+  def __setitem__(self, key, value):
+    self.entries.pop(key, None)
+    self.entries[key] = value
+    while len(self.entries) > self.max_entries:
+      self.entries.popitem(last=False)
+
+
+# Due to a python pickling issue, the following functions must be at top
 # level, or multiprocessing pool spawn won't find them.
 def g_llvm_nm_uncached(filename):
   return Building.llvm_nm_uncached(filename)
 
 
+def g_llvm_nm_uncached_batch(filenames):
+  return list(zip(filenames, Building.llvm_nm_uncached_batch(filenames)))
+
+
 def g_multiprocessing_initializer(*args):
   for item in args:
     (key, value) = item.split('=', 1)
@@ -1445,6 +1869,18 @@ def g_multiprocessing_initializer(*args):
       os.environ[key] = value
 
 
+# file signatures (magic numbers)
+AR_SIGNATURE = b'!<arch>\n'
+BITCODE_SIGNATURE = b'BC'
+BITCODE_WRAPPER_SIGNATURE = b'\xde\xc0\x17\x0b' # the 20-byte wrapper used on macOS
+
+
+# the .js externs files in a directory of the tree, which do not change while we run
+@memoize
+def list_closure_externs(dirname):
+  return tuple(os.path.join(dirname, name) for name in os.listdir(dirname) if name.endswith('.js'))
+
+
 #  Building
 class Building(object):
   COMPILER = CLANG
@@ -1452,6 +1888,10 @@ class Building(object):
   COMPILER_TEST_OPTS = [] # For use of the test runner
   JS_ENGINE_OVERRIDE = None # Used to pass the JS engine override from runner.py -> test_benchmark.py
   multiprocessing_pool = None
+  thread_pool = None
+  building_env_cache = {}
+  NM_BATCH_SIZE = 64 # most files to pass to a single llvm-nm run, to keep command lines short
+  REACHABLE_PATTERN = re.compile(r'^// REACHABLE (.+)$', re.M) # a function's targets, in dumpCallGraph output
 
   @staticmethod
   def get_num_cores():
@@ -1474,6 +1914,9 @@ class Building(object):
             for t in tasks:
               results += [func(t)]
             return results
+
+          def imap_unordered(self, func, tasks, chunksize=1):
+            return self.map(func, tasks)
         Building.multiprocessing_pool = FakeMultiprocessor()
       else:
         child_env = [
@@ -1493,6 +1936,9 @@ class Building(object):
           # children, that could cause a quadratic amount of spawned processes.
           'EMCC_CORES=1'
         ]
+        # Where children are spawned rather than forked (e.g. on Windows), they
+        # import this module again before the initializer runs; check_vanilla()
+        # handles that case without needing EMCC_WASM_BACKEND.
         Building.multiprocessing_pool = multiprocessing.Pool(processes=cores, initializer=g_multiprocessing_initializer, initargs=child_env)
 
         def close_multiprocessing_pool():
@@ -1510,14 +1956,26 @@ class Building(object):
 
     return Building.multiprocessing_pool
 
+  # Tasks that mostly wait on a subprocess of their own (llvm-nm, llvm-ar) do not
+  # need a child process each, so run those on threads, which are much cheaper
+  # to start than the multiprocessing pool.
+  @staticmethod
+  def get_thread_pool():
+    if not Building.thread_pool:
+      cores = Building.get_num_cores()
+      if cores == 1:
+        # the single core mock pool runs everything serially on this thread already
+        return Building.get_multiprocessing_pool()
+      Building.thread_pool = multiprocessing.pool.ThreadPool(processes=cores)
+      atexit.register(Building.thread_pool.terminate)
+    return Building.thread_pool
+
   # When creating environment variables for Makefiles to execute, we need to doublequote the commands if they have spaces in them..
   @staticmethod
   def doublequote_spaces(arg):
-    arg = arg[:] # Operate on a copy of the input string/list
     if isinstance(arg, list):
-      for i in range(len(arg)):
-        arg[i] = Building.doublequote_spaces(arg[i])
-      return arg
+      # build a new list rather than modifying the caller's
+      return [Building.doublequote_spaces(a) for a in arg]
 
     if ' ' in arg and (not (arg.startswith('"') and arg.endswith('"'))) and (not (arg.startswith("'") and arg.endswith("'"))):
       return '"' + arg.replace('"', '\\"') + '"'
@@ -1527,11 +1985,9 @@ class Building(object):
   # .. but for Popen, we cannot have doublequotes, so provide functionality to remove them when needed.
   @staticmethod
   def remove_quotes(arg):
-    arg = arg[:] # Operate on a copy of the input string/list
     if isinstance(arg, list):
-      for i in range(len(arg)):
-        arg[i] = Building.remove_quotes(arg[i])
-      return arg
+      # build a new list rather than modifying the caller's
+      return [Building.remove_quotes(a) for a in arg]
 
     if arg.startswith('"') and arg.endswith('"'):
       return arg[1:-1].replace('\\"', '"')
@@ -1559,7 +2015,8 @@ class Building(object):
         if env.get(dangerous) and env.get(dangerous) == non_native.get(dangerous):
           del env[dangerous] # better to delete it than leave it, as the non-native one is definitely wrong
       return env
-    # point CC etc. to the em* tools.
+    # point CC etc. to the em* tools. those values only depend on the settings
+    # in the key below, not on the environment, so they are computed once.
     # on windows, we must specify python explicitly. on other platforms, we prefer
     # not to, as some configure scripts expect e.g. CC to be a literal executable
     # (but "python emcc.py" is not a file that exists).
@@ -1567,32 +2024,49 @@ class Building(object):
     # emcc.py etc. The unsuffixed versions have the python_selector logic that can
     # pick the right version as needed (which is not crucial right now as we support
     # both 2 and 3, but eventually we may be 3-only).
-    env['CC'] = quote(unsuffixed(EMCC)) if not WINDOWS else 'python %s' % quote(EMCC)
-    env['CXX'] = quote(unsuffixed(EMXX)) if not WINDOWS else 'python %s' % quote(EMXX)
-    env['AR'] = quote(unsuffixed(EMAR)) if not WINDOWS else 'python %s' % quote(EMAR)
-    env['LD'] = quote(unsuffixed(EMCC)) if not WINDOWS else 'python %s' % quote(EMCC)
-    env['NM'] = quote(LLVM_NM)
-    env['LDSHARED'] = quote(unsuffixed(EMCC)) if not WINDOWS else 'python %s' % quote(EMCC)
-    env['RANLIB'] = quote(unsuffixed(EMRANLIB)) if not WINDOWS else 'python %s' % quote(EMRANLIB)
-    env['EMMAKEN_COMPILER'] = quote(Building.COMPILER)
-    env['EMSCRIPTEN_TOOLS'] = path_from_root('tools')
-    env['CFLAGS'] = env['EMMAKEN_CFLAGS'] = ' '.join(Building.COMPILER_TEST_OPTS)
-    env['HOST_CC'] = quote(CLANG_CC)
-    env['HOST_CXX'] = quote(CLANG_CPP)
-    env['HOST_CFLAGS'] = "-W" # if set to nothing, CFLAGS is used, which we don't want
-    env['HOST_CXXFLAGS'] = "-W" # if set to nothing, CXXFLAGS is used, which we don't want
-    env['PKG_CONFIG_LIBDIR'] = path_from_root('system', 'local', 'lib', 'pkgconfig') + os.path.pathsep + path_from_root('system', 'lib', 'pkgconfig')
+    key = (doublequote_commands, Building.COMPILER, tuple(Building.COMPILER_TEST_OPTS))
+    if key not in Building.building_env_cache:
+      def tool_command(tool):
+        return Building.tool_command(tool, doublequote_commands)
+
+      emcc_command = tool_command(EMCC)
+      Building.building_env_cache[key] = {
+        'CC': emcc_command,
+        'CXX': tool_command(EMXX),
+        'AR': tool_command(EMAR),
+        'LD': emcc_command,
+        'NM': quote(LLVM_NM),
+        'LDSHARED': emcc_command,
+        'RANLIB': tool_command(EMRANLIB),
+        'EMMAKEN_COMPILER': quote(Building.COMPILER),
+        'EMSCRIPTEN_TOOLS': path_from_root('tools'),
+        'CFLAGS': ' '.join(Building.COMPILER_TEST_OPTS),
+        'EMMAKEN_CFLAGS': ' '.join(Building.COMPILER_TEST_OPTS),
+        'HOST_CC': quote(CLANG_CC),
+        'HOST_CXX': quote(CLANG_CPP),
+        'HOST_CFLAGS': "-W", # if set to nothing, CFLAGS is used, which we don't want
+        'HOST_CXXFLAGS': "-W", # if set to nothing, CXXFLAGS is used, which we don't want
+        'PKG_CONFIG_LIBDIR': path_from_root('system', 'local', 'lib', 'pkgconfig') + os.path.pathsep + path_from_root('system', 'lib', 'pkgconfig'),
+        'EMSCRIPTEN': path_from_root(),
+        'CROSS_COMPILE': path_from_root('em'), # produces /path/to/emscripten/em , which then can have 'cc', 'ar', etc appended to it
+      }
+    env.update(Building.building_env_cache[key])
+    # these depend on the current environment, so they are not cached
     env['PKG_CONFIG_PATH'] = os.environ.get('EM_PKG_CONFIG_PATH', '')
-    env['EMSCRIPTEN'] = path_from_root()
-    env['PATH'] = path_from_root('system', 'bin') + os.pathsep + env['PATH']
-    env['CROSS_COMPILE'] = path_from_root('em') # produces /path/to/emscripten/em , which then can have 'cc', 'ar', etc appended to it
+    env['PATH'] = SYSTEM_BIN_DIR + os.pathsep + env['PATH']
     return env
 
+  # the command get_building_env points CC etc. at for one of the em* tools
+  @staticmethod
+  def tool_command(tool, doublequote_commands=False):
+    quote = Building.doublequote_spaces if doublequote_commands else (lambda arg: arg)
+    return quote(unsuffixed(tool)) if not WINDOWS else 'python %s' % quote(tool)
+
   # if we are in emmake mode, i.e., we changed the env to run emcc etc., then show the message and abort
   @staticmethod
   def ensure_no_emmake(message):
-    non_native = Building.get_building_env()
-    if os.environ.get('CC') == non_native.get('CC'):
+    # only CC is compared, so there is no need to build the whole environment
+    if os.environ.get('CC') == Building.tool_command(EMCC):
       # the environment CC is the one we change to when forcing our em* tools
       exit_with_error(message)
 
@@ -1616,15 +2090,21 @@ class Building(object):
       if is_exe(program):
         return program
     else:
+      candidates = [program]
+      if WINDOWS:
+        candidates += [program + suffix for suffix in ('.exe', '.cmd', '.bat')]
+      # the PATH index answers the common case without a stat per directory
+      exe_file = path_lookup(candidates)
+      if exe_file and os.access(exe_file, os.X_OK) and (PATH_INDEX_HOLDS_ONLY_FILES or os.path.isfile(exe_file)):
+        return exe_file
+      # the index may be out of date (e.g. the program was installed after it
+      # was built), so look for real before reporting a miss
       for path in os.environ["PATH"].split(os.pathsep):
         path = path.strip('"')
-        exe_file = os.path.join(path, program)
-        if is_exe(exe_file):
-          return exe_file
-        if WINDOWS:
-          for suffix in ('.exe', '.cmd', '.bat'):
-            if is_exe(exe_file + suffix):
-              return exe_file + suffix
+        for candidate in candidates:
+          exe_file = os.path.join(path, candidate)
+          if is_exe(exe_file):
+            return exe_file
 
     return None
 
@@ -1636,21 +2116,15 @@ class Building(object):
     if not WINDOWS:
       return env
     path = env['PATH'].split(';')
-    path = [p for p in path if not os.path.exists(os.path.join(p, 'sh.exe'))]
-    env['PATH'] = ';'.join(path)
+    without_sh = [p for p in path if not os.path.exists(os.path.join(p, 'sh.exe'))]
+    if len(without_sh) != len(path):
+      env['PATH'] = ';'.join(without_sh)
     return env
 
   @staticmethod
   def handle_CMake_toolchain(args, env):
-
-    def has_substr(array, substr):
-      for arg in array:
-        if substr in arg:
-          return True
-      return False
-
     # Append the Emscripten toolchain file if the user didn't specify one.
-    if not has_substr(args, '-DCMAKE_TOOLCHAIN_FILE'):
+    if not any('-DCMAKE_TOOLCHAIN_FILE' in arg for arg in args):
       args.append('-DCMAKE_TOOLCHAIN_FILE=' + path_from_root('cmake', 'Modules', 'Platform', 'Emscripten.cmake'))
 
     # On Windows specify MinGW Makefiles if we have MinGW and no other toolchain was specified, to avoid CMake
@@ -1692,7 +2166,7 @@ class Building(object):
       raise
     if 'EMMAKEN_JUST_CONFIGURE' in env:
       del env['EMMAKEN_JUST_CONFIGURE']
-    if res.returncode is not 0:
+    if res.returncode != 0:
       logging.error('Configure step failed with non-zero return code: %s.  Command line: %s at %s' % (res.returncode, ' '.join(args), os.getcwd()))
       raise subprocess.CalledProcessError(cmd=args, returncode=res.returncode)
 
@@ -1815,12 +2289,14 @@ class Building(object):
             Building.make(make + make_args, stdout=stdout, stderr=stderr, env=env)
           except subprocess.CalledProcessError as e:
             pass # Ignore exit code != 0
+      # the second pass only runs if the first did not produce all the libs
       try:
         if cache is not None:
-          cache[cache_name] = []
+          contents = []
           for f in generated_libs:
-            basename = os.path.basename(f)
-            cache[cache_name].append((basename, open(f, 'rb').read()))
+            with open(f, 'rb') as lib:
+              contents.append((os.path.basename(f), lib.read()))
+          cache[cache_name] = contents
         break
       except Exception as e:
         if i > 0:
@@ -1848,33 +2324,61 @@ class Building(object):
   @staticmethod
   def parallel_llvm_nm(files):
     with ToolchainProfiler.profile_block('parallel_llvm_nm'):
-      pool = Building.get_multiprocessing_pool()
-      object_contents = pool.map(g_llvm_nm_uncached, files)
-
-      for i in range(len(files)):
-        if object_contents[i].returncode != 0:
-          logging.debug('llvm-nm failed on file ' + files[i] + ': return code ' + str(object_contents[i].returncode) + ', error: ' + object_contents[i].output)
-        Building.uninternal_nm_cache[files[i]] = object_contents[i]
-      return object_contents
-
+      # llvm-nm accepts several files at once, so hand each worker a batch of
+      # them rather than spawning llvm-nm once per file
+      # results are collected here as well as in the cache, which may evict some
+      # of them when there are many files
+      results = {}
+      unique_files = []
+      for f in unique_ordered(files):
+        result = Building.get_persistent_nm(f)
+        if result is not None:
+          Building.uninternal_nm_cache[f] = results[f] = result
+        else:
+          unique_files.append(f)
+      batch_size = min(Building.NM_BATCH_SIZE, max(1, (len(unique_files) + Building.get_num_cores() - 1) // Building.get_num_cores()))
+      batches = [unique_files[i:i + batch_size] for i in range(0, len(unique_files), batch_size)]
+      # a single batch is not worth handing over to the pool
+      if len(batches) <= 1:
+        all_results = [g_llvm_nm_uncached_batch(batch) for batch in batches]
+      else:
+        all_results = Building.get_thread_pool().imap_unordered(g_llvm_nm_uncached_batch, batches)
+      # each worker returns (filename, result) pairs, so batches can be consumed
+      # in whatever order they finish and the input order restored afterwards
+      for batch_results in all_results:
+        for f, result in batch_results:
+          if result.returncode != 0:
+            logging.debug('llvm-nm failed on file %s: return code %s, error: %s', f, result.returncode, result.output)
+          Building.uninternal_nm_cache[f] = results[f] = result
+          Building.set_persistent_nm(f, result)
+      return [results[f] for f in files]
+
+  # Returns the llvm-nm results of every object file the link of the given files
+  # may look at (the bitcode files, and all the files in the archives), keyed
+  # on their paths. The link uses these rather than the nm caches, which may
+  # drop some of them when there are many files.
   @staticmethod
   def read_link_inputs(files):
     with ToolchainProfiler.profile_block('read_link_inputs'):
       # Before performing the link, we need to look at each input file to determine which symbols
       # each of them provides. Do this in multiple parallel processes.
+      link_inputs = {}
       archive_names = [] # .a files passed in to the command line to the link
-      object_names = [] # .o/.bc files passed in to the command line to the link
+      new_archive_names = [] # the ones among them that still need extracting
+      object_names = [] # .o/.bc files passed in to the command line to the link, or in its archives
       for f in files:
         absolute_path_f = Building.make_paths_absolute(f)
 
-        if absolute_path_f not in Building.ar_contents and Building.is_ar(absolute_path_f):
+        if absolute_path_f in Building.ar_contents:
           archive_names.append(absolute_path_f)
-        elif absolute_path_f not in Building.uninternal_nm_cache and Building.is_bitcode(absolute_path_f):
+        elif Building.is_ar(absolute_path_f):
+          archive_names.append(absolute_path_f)
+          new_archive_names.append(absolute_path_f)
+        elif Building.is_bitcode(absolute_path_f):
           object_names.append(absolute_path_f)
 
       # Archives contain objects, so process all archives first in parallel to obtain the object files in them.
-      pool = Building.get_multiprocessing_pool()
-      object_names_in_archives = pool.map(extract_archive_contents, archive_names)
+      object_names_in_archives = extract_archive_contents_batch(new_archive_names)
 
       def clean_temporary_archive_contents_directory(directory):
         def clean_at_exit():
@@ -1882,20 +2386,25 @@ class Building(object):
         if directory:
           atexit.register(clean_at_exit)
 
-      for n in range(len(archive_names)):
+      for n in range(len(new_archive_names)):
         if object_names_in_archives[n]['returncode'] != 0:
-          raise Exception('llvm-ar failed on archive ' + archive_names[n] + '!')
-        Building.ar_contents[archive_names[n]] = object_names_in_archives[n]['files']
+          raise Exception('llvm-ar failed on archive ' + new_archive_names[n] + '!')
+        Building.ar_contents[new_archive_names[n]] = object_names_in_archives[n]['files']
         clean_temporary_archive_contents_directory(object_names_in_archives[n]['dir'])
 
-      for o in object_names_in_archives:
-        for f in o['files']:
-          if f not in Building.uninternal_nm_cache:
-            object_names.append(f)
+      for archive in archive_names:
+        object_names += Building.ar_contents[archive]
 
-      # Next, extract symbols from all object files (either standalone or inside archives we just extracted)
-      # The results are not used here directly, but populated to llvm-nm cache structure.
-      Building.parallel_llvm_nm(object_names)
+      # Next, extract symbols from all object files (either standalone or inside archives we just extracted),
+      # reusing what the llvm-nm cache already has.
+      uncached_names = []
+      for f in object_names:
+        if f in Building.uninternal_nm_cache:
+          link_inputs[f] = Building.uninternal_nm_cache[f]
+        else:
+          uncached_names.append(f)
+      link_inputs.update(zip(uncached_names, Building.parallel_llvm_nm(uncached_names)))
+      return link_inputs
 
   @staticmethod
   def llvm_backend_args():
@@ -1937,8 +2446,7 @@ class Building(object):
     elif not Settings.ALLOW_MEMORY_GROWTH:
       cmd.append('--max-memory=%d' % Settings.TOTAL_MEMORY)
 
-    for a in Building.llvm_backend_args():
-      cmd += ['-mllvm', a]
+    cmd.extend(x for a in Building.llvm_backend_args() for x in ('-mllvm', a))
 
     # emscripten-wasm-finalize currently depends on the presence of debug
     # symbols for renaming of the __invoke symbols
@@ -1950,14 +2458,14 @@ class Building(object):
     if Settings.EXPORT_ALL:
       cmd += ['--no-gc-sections', '--export-all']
     else:
-      for export in expand_response(Settings.EXPORTED_FUNCTIONS):
-        cmd += ['--export', export[1:]] # Strip the leading underscore
+      # Strip the leading underscore
+      cmd.extend(x for export in expand_response(Settings.EXPORTED_FUNCTIONS) for x in ('--export', export[1:]))
 
     logging.debug('emcc: lld-linking: %s to %s', files, target)
     t = time.time()
     check_call(cmd)
     if DEBUG:
-      logging.debug('  emscript: lld took %s seconds' % (time.time() - t))
+      logging.debug('  emscript: lld took %s seconds', time.time() - t)
       t = time.time()
 
     return target
@@ -1974,10 +2482,7 @@ class Building(object):
     resolved_symbols = set()
     # Paths of already included object files from archives.
     added_contents = set()
-    has_ar = False
-    for f in files:
-      if not f.startswith('-'):
-        has_ar = has_ar or Building.is_ar(Building.make_paths_absolute(f))
+    has_ar = any(Building.is_ar(Building.make_paths_absolute(f)) for f in files if not f.startswith('-'))
 
     # If we have only one archive or the force_archive_contents flag is set,
     # then we will add every object file we see, regardless of whether it
@@ -1989,7 +2494,9 @@ class Building(object):
     # If the object is included, the symbol tables are updated and the function
     # returns True.
     def consider_object(f, force_add=False):
-      new_symbols = Building.llvm_nm(f)
+      new_symbols = link_inputs.get(f)
+      if new_symbols is None:
+        new_symbols = Building.llvm_nm(f)
       # Check if the object was valid according to llvm-nm. It also accepts
       # native object files.
       if not new_symbols.is_valid_for_nm():
@@ -2000,10 +2507,10 @@ class Building(object):
       if not Building.is_bitcode(f):
         logging.warning('object %s is not LLVM bitcode, cannot link' % (f))
         return False
-      provided = new_symbols.defs.union(new_symbols.commons)
+      provided = new_symbols.provided
       do_add = force_add or not unresolved_symbols.isdisjoint(provided)
       if do_add:
-        logging.debug('adding object %s to link' % (f))
+        logging.debug('adding object %s to link', f)
         # Update resolved_symbols table with newly resolved symbols
         resolved_symbols.update(provided)
         # Update unresolved_symbols table by adding newly unresolved symbols and
@@ -2019,11 +2526,14 @@ class Building(object):
     def consider_archive(f):
       added_any_objects = False
       loop_again = True
-      logging.debug('considering archive %s' % (f))
+      logging.debug('considering archive %s', f)
       contents = Building.ar_contents[f]
       while loop_again: # repeatedly traverse until we have everything we need
         loop_again = False
         for content in contents:
+          # once nothing is unresolved, no further object can be pulled in
+          if not unresolved_symbols and not force_add_all:
+            break
           if content in added_contents:
             continue
           # Link in the .o if it provides symbols, *or* this is a singleton archive (which is apparently an exception in gcc ld)
@@ -2031,10 +2541,10 @@ class Building(object):
             added_contents.add(content)
             loop_again = True
             added_any_objects = True
-      logging.debug('done running loop of archive %s' % (f))
+      logging.debug('done running loop of archive %s', f)
       return added_any_objects
 
-    Building.read_link_inputs([x for x in files if not x.startswith('-')])
+    link_inputs = Building.read_link_inputs([x for x in files if not x.startswith('-')])
 
     current_archive_group = None
 
@@ -2097,35 +2607,72 @@ class Building(object):
     link_args = actual_files
     # 8k is a bit of an arbitrary limit, but a reasonable one
     # for max command line size before we use a response file
-    response_file = None
+    response_contents = None
     if len(' '.join(link_args)) > 8192:
       logging.debug('using response file for llvm-link')
-      response_file = temp_files.get(suffix='.response').name
 
-      link_args = ["@" + response_file]
+      # Starting from LLVM 3.9.0 trunk around July 2016, LLVM escapes backslashes in response files, so Windows paths
+      # "c:\path\to\file.txt" with single slashes no longer work. LLVM upstream dev 3.9.0 from January 2016 still treated
+      # backslashes without escaping. To preserve compatibility with both versions of llvm-link, don't pass backslash
+      # path delimiters at all to response files, but always use forward slashes.
+      response_args = actual_files
+      if WINDOWS:
+        response_args = [arg.replace('\\', '/') for arg in actual_files]
 
-      response_fh = open(response_file, 'w')
-      for arg in actual_files:
-        # Starting from LLVM 3.9.0 trunk around July 2016, LLVM escapes backslashes in response files, so Windows paths
-        # "c:\path\to\file.txt" with single slashes no longer work. LLVM upstream dev 3.9.0 from January 2016 still treated
-        # backslashes without escaping. To preserve compatibility with both versions of llvm-link, don't pass backslash
-        # path delimiters at all to response files, but always use forward slashes.
-        if WINDOWS:
-          arg = arg.replace('\\', '/')
+      # escaped double quotes allows 'space' characters in pathname the response file can use
+      response_contents = ''.join('"%s"\n' % arg for arg in response_args)
 
-        # escaped double quotes allows 'space' characters in pathname the response file can use
-        response_fh.write("\"" + arg + "\"\n")
-      response_fh.close()
+      # when we run llvm-link right away, we can usually hand it the response
+      # file through a pipe instead of writing it to disk. the caller of
+      # just_calculate needs an actual file though.
+      if just_calculate or not Building.can_pipe_response_files():
+        response_file = temp_files.get(suffix='.response').name
+        with open(response_file, 'w') as response_fh:
+          response_fh.write(response_contents)
+        link_args = ["@" + response_file]
+        response_contents = None
 
     if not just_calculate:
       logging.debug('emcc: llvm-linking: %s to %s', actual_files, target)
-      output = run_process([LLVM_LINK] + link_args + ['-o', target], stdout=PIPE).stdout
+      if response_contents is not None:
+        output = Building.run_with_piped_response_file([LLVM_LINK], response_contents, ['-o', target], stdout=PIPE).stdout
+      else:
+        output = run_process([LLVM_LINK] + link_args + ['-o', target], stdout=PIPE).stdout
       assert os.path.exists(target) and (output is None or 'Could not open input file' not in output), 'Linking error: ' + output
       return target
     else:
       # just calculating; return the link arguments which is the final list of files to link
       return link_args
 
+  # Response files can be passed as /dev/fd/N of an inherited pipe where that
+  # exists, and where subprocess can pass a specific fd on to the child
+  # (pass_fds, Python 3). In debug mode we write real files, so they are kept.
+  @staticmethod
+  def can_pipe_response_files():
+    return not WINDOWS and sys.version_info >= (3, 2) and not DEBUG and os.path.isdir('/dev/fd')
+
+  # Runs cmd_prefix + [@response file] + cmd_suffix, feeding the response file
+  # contents through a pipe from a separate thread (the pipe buffer is smaller
+  # than a large response file).
+  @staticmethod
+  def run_with_piped_response_file(cmd_prefix, contents, cmd_suffix, **kw):
+    read_fd, write_fd = os.pipe()
+
+    def feed():
+      try:
+        with os.fdopen(write_fd, 'w') as f:
+          f.write(contents)
+      except (IOError, OSError):
+        pass # the process exited without reading everything; it reports its own error
+
+    writer = threading.Thread(target=feed)
+    writer.start()
+    try:
+      return run_process(cmd_prefix + ['@/dev/fd/%d' % read_fd] + cmd_suffix, pass_fds=(read_fd,), **kw)
+    finally:
+      os.close(read_fd)
+      writer.join()
+
   # LLVM optimizations
   # @param opt A list of LLVM optimization parameters
   @staticmethod
@@ -2146,7 +2693,8 @@ class Building(object):
     else:
       opts += ['-force-vector-width=4']
 
-    logging.debug('emcc: LLVM opts: ' + ' '.join(opts) + '  [num inputs: ' + str(len(inputs)) + ']')
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+      logging.debug('emcc: LLVM opts: %s  [num inputs: %d]', ' '.join(opts), len(inputs))
     target = out or (filename + '.opt.bc')
     try:
       run_process([LLVM_OPT] + inputs + opts + ['-o', target], stdout=PIPE)
@@ -2198,31 +2746,143 @@ class Building(object):
     defs = []
     undefs = []
     commons = []
-    for line in output.split('\n'):
-      if len(line) == 0:
-        continue
-      if ':' in line:
-        continue # e.g.  filename.o:  , saying which file it's from
-      parts = [seg for seg in line.split(' ') if len(seg)]
-      # pnacl-nm will print zero offsets for bitcode, and newer llvm-nm will print present symbols as  -------- T name
-      if len(parts) == 3 and parts[0] in ["00000000", "--------"]:
-        parts.pop(0)
-      if len(parts) == 2:  # ignore lines with absolute offsets, these are not bitcode anyhow (e.g. |00000630 t d_source_name|)
-        status, symbol = parts
-        if status == 'U':
-          undefs.append(symbol)
-        elif status == 'C':
-          commons.append(symbol)
-        elif (not include_internal and status == status.upper()) or \
-             (include_internal and status in ['W', 't', 'T', 'd', 'D']): # FIXME: using WTD in the previous line fails due to llvm-nm behavior on macOS,
-          #        so for now we assume all uppercase are normally defined external symbols
-          defs.append(symbol)
-    return ObjectFileInfo(0, None, set(defs), set(undefs), set(commons))
-
-  internal_nm_cache = {} # cache results of nm - it can be slow to run
-  uninternal_nm_cache = {}
+    for status, symbol in NM_SYMBOL_PATTERN.findall(output):
+      if status == 'U':
+        undefs.append(symbol)
+      elif status == 'C':
+        commons.append(symbol)
+      elif (not include_internal and status == status.upper()) or \
+           (include_internal and status in ['W', 't', 'T', 'd', 'D']): # FIXME: using WTD in the previous line fails due to llvm-nm behavior on macOS,
+        #        so for now we assume all uppercase are normally defined external symbols
+        defs.append(symbol)
+    return ObjectFileInfo(0, None, frozenset(defs), set(undefs), frozenset(commons))
+
+  internal_nm_cache = NmCache() # cache results of nm - it can be slow to run
+  uninternal_nm_cache = NmCache()
   ar_contents = {} # Stores the object files contained in different archive files passed as input
 
+  # llvm-nm results are also kept on disk, so that later emcc invocations do not
+  # need to run llvm-nm again on inputs that did not change (e.g. the system
+  # libraries, or the unchanged objects of an incremental build). An entry is only
+  # used while the file's mtime and size still match the ones recorded with it,
+  # and only the most recently used entries are kept.
+  persistent_nm_cache = None
+  persistent_nm_cache_dirty = False
+  PERSISTENT_NM_CACHE_MAX_ENTRIES = 5000
+
+  @staticmethod
+  def get_persistent_nm_cache_file():
+    return os.path.join(Cache.dirname, 'nm_cache.json')
+
+  # the results are only valid for the emscripten version (which parses them) and
+  # the llvm-nm binary that produced them
+  @staticmethod
+  def get_persistent_nm_cache_tag():
+    try:
+      llvm_nm_mtime = os.path.getmtime(LLVM_NM)
+    except OSError:
+      llvm_nm_mtime = None
+    return [EMSCRIPTEN_VERSION, LLVM_NM, llvm_nm_mtime]
+
+  @staticmethod
+  def read_persistent_nm_cache_file():
+    try:
+      with open(Building.get_persistent_nm_cache_file()) as f:
+        data = json.load(f)
+      if data['tag'] == Building.get_persistent_nm_cache_tag():
+        return data['files']
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+      pass
+    return {}
+
+  @staticmethod
+  def load_persistent_nm_cache():
+    if Building.persistent_nm_cache is None:
+      Building.persistent_nm_cache = Building.read_persistent_nm_cache_file()
+    return Building.persistent_nm_cache
+
+  # files in temp dirs (emcc's own build dirs, which are made under TEMP_DIR,
+  # and the ones archives are extracted to) get new names in every run, so
+  # there is no point in saving them. The cache dir may itself be under
+  # TEMP_DIR, and its files are the ones most worth saving.
+  @staticmethod
+  def is_persistent_nm_candidate(filename):
+    def is_under(d):
+      return d and filename.startswith(os.path.join(os.path.abspath(d), ''))
+
+    if ARCHIVE_CONTENTS_SUFFIX + os.sep in filename:
+      return False
+    if is_under(Cache.dirname):
+      return True
+    return not any(is_under(d) for d in (TEMP_DIR, CANONICAL_TEMP_DIR, EMSCRIPTEN_TEMP_DIR))
+
+  @staticmethod
+  def mark_persistent_nm_cache_dirty():
+    if not Building.persistent_nm_cache_dirty:
+      Building.persistent_nm_cache_dirty = True
+      atexit.register(Building.save_persistent_nm_cache)
+
+  @staticmethod
+  def get_persistent_nm(filename):
+    entry = Building.load_persistent_nm_cache().get(filename)
+    if entry is None:
+      return None
+    try:
+      if Building.file_cache_key(filename) != (filename, entry['mtime'], entry['size']):
+        return None
+      defs, undefs, commons = [[asstr(symbol) for symbol in entry[key]] for key in ('defs', 'undefs', 'commons')]
+    except (OSError, KeyError, TypeError):
+      return None
+    # refreshing the use time means saving the whole file again, so only do it
+    # once in a while
+    now = time.time()
+    if entry.get('used', 0) < now - 24 * 60 * 60:
+      entry['used'] = now
+      Building.mark_persistent_nm_cache_dirty()
+    return ObjectFileInfo(0, None, frozenset(defs), set(undefs), frozenset(commons))
+
+  @staticmethod
+  def set_persistent_nm(filename, result):
+    if not result.is_valid_for_nm() or not Building.is_persistent_nm_candidate(filename):
+      return
+    try:
+      key = Building.file_cache_key(filename)
+    except OSError:
+      return
+    Building.load_persistent_nm_cache()[filename] = {
+      'mtime': key[1],
+      'size': key[2],
+      'defs': sorted(result.defs),
+      'undefs': sorted(result.undefs),
+      'commons': sorted(result.commons),
+      'used': time.time(),
+    }
+    Building.mark_persistent_nm_cache_dirty()
+
+  @staticmethod
+  def save_persistent_nm_cache():
+    if not Building.persistent_nm_cache_dirty:
+      return
+    Building.persistent_nm_cache_dirty = False
+    cache_file = Building.get_persistent_nm_cache_file()
+    # keep what other processes saved in the meantime, and write to a temp file
+    # that is renamed into place, so that nobody ever reads a partial file
+    files = Building.read_persistent_nm_cache_file()
+    files.update(Building.persistent_nm_cache)
+    if len(files) > Building.PERSISTENT_NM_CACHE_MAX_ENTRIES:
+      recent = sorted(files, key=lambda f: files[f].get('used', 0), reverse=True)[:Building.PERSISTENT_NM_CACHE_MAX_ENTRIES]
+      files = dict((f, files[f]) for f in recent)
+    temp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+    try:
+      with open(temp_file, 'w') as f:
+        json.dump({'tag': Building.get_persistent_nm_cache_tag(), 'files': files}, f)
+      if WINDOWS:
+        try_delete(cache_file)
+      os.rename(temp_file, cache_file)
+    except (IOError, OSError) as e:
+      logging.debug('failed to save llvm-nm cache %s: %s', cache_file, e)
+      try_delete(temp_file)
+
   @staticmethod
   def llvm_nm_uncached(filename, stdout=PIPE, stderr=PIPE, include_internal=False):
     # LLVM binary ==> list of symbols
@@ -2232,6 +2892,27 @@ class Building(object):
     else:
       return ObjectFileInfo(proc.returncode, str(proc.stdout) + str(proc.stderr))
 
+  # Runs llvm-nm once on several files, and splits its output at the "filename:"
+  # line it prints before the symbols of each file. If that fails (e.g. when one
+  # of the files is not valid), falls back to one run per file, so that each
+  # file gets its own return code and error output.
+  @staticmethod
+  def llvm_nm_uncached_batch(filenames, include_internal=False):
+    if len(filenames) == 1:
+      return [Building.llvm_nm_uncached(filenames[0], include_internal=include_internal)]
+    proc = run_process([LLVM_NM] + filenames, stdout=PIPE, stderr=PIPE, check=False)
+    if proc.returncode != 0:
+      return [Building.llvm_nm_uncached(f, include_internal=include_internal) for f in filenames]
+    headers = dict((f + ':', i) for i, f in enumerate(filenames))
+    outputs = [[] for f in filenames]
+    current = None
+    for line in proc.stdout.split('\n'):
+      if line in headers:
+        current = outputs[headers[line]]
+      elif current is not None:
+        current.append(line)
+    return [Building.parse_symbols('\n'.join(output), include_internal) for output in outputs]
+
   @staticmethod
   def llvm_nm(filename, stdout=PIPE, stderr=PIPE, include_internal=False):
     # Always use absolute paths to maximize cache usage
@@ -2242,10 +2923,14 @@ class Building(object):
     elif not include_internal and filename in Building.uninternal_nm_cache:
       return Building.uninternal_nm_cache[filename]
 
-    ret = Building.llvm_nm_uncached(filename, stdout, stderr, include_internal)
+    ret = None if include_internal else Building.get_persistent_nm(filename)
+    if ret is None:
+      ret = Building.llvm_nm_uncached(filename, stdout, stderr, include_internal)
+      if not include_internal:
+        Building.set_persistent_nm(filename, ret)
 
     if ret.returncode != 0:
-      logging.debug('llvm-nm failed on file ' + filename + ': return code ' + str(ret.returncode) + ', error: ' + ret.output)
+      logging.debug('llvm-nm failed on file %s: return code %s, error: %s', filename, ret.returncode, ret.output)
 
     # Even if we fail, write the results to the NM cache so that we don't keep trying to llvm-nm the failing file again later.
     if include_internal:
@@ -2392,15 +3077,12 @@ class Building(object):
       temp = configuration.get_temp_files().get('.js').name
       Building.js_optimizer(infile, ['dumpCallGraph'], output_filename=temp, just_concat=True)
       asm = asm_module.AsmModule(temp)
-      lines = asm.funcs_js.split('\n')
       can_call = {}
-      for i in range(len(lines)):
-        line = lines[i]
-        if line.startswith('// REACHABLE '):
-          curr = json.loads(line[len('// REACHABLE '):])
-          func = curr[0]
-          targets = curr[2]
-          can_call[func] = set(targets)
+      for m in Building.REACHABLE_PATTERN.finditer(asm.funcs_js):
+        curr = json.loads(m.group(1))
+        func = curr[0]
+        targets = curr[2]
+        can_call[func] = set(targets)
       # function tables too - treat a function all as a function that can call anything in it, which is effectively what it is
       for name, funcs in asm.tables.items():
         can_call[name] = set([x.strip() for x in funcs[1:-1].split(',')])
@@ -2411,19 +3093,21 @@ class Building(object):
       reachable_from = {}
       for func, targets in can_call.items():
         for target in targets:
-          if target not in reachable_from:
-            reachable_from[target] = set()
-          reachable_from[target].add(func)
+          reachable_from.setdefault(target, set()).add(func)
       # print 'reachable from', reachable_from
       to_check = initial_list[:]
       advised = set()
+      # dyncalls and tables are walked through but not advised, so keep track of
+      # what was visited separately, to walk each function only once
+      visited = set()
       if can_reach:
         # find all functions that can reach the initial list
         while len(to_check):
           curr = to_check.pop()
           if curr in reachable_from:
             for reacher in reachable_from[curr]:
-              if reacher not in advised:
+              if reacher not in visited:
+                visited.add(reacher)
                 if not JS.is_dyn_call(reacher) and not JS.is_function_table(reacher):
                   advised.add(str(reacher))
                 to_check.append(reacher)
@@ -2434,6 +3118,9 @@ class Building(object):
           to_check.append(name)
         while len(to_check):
           curr = to_check.pop()
+          if curr in visited:
+            continue
+          visited.add(curr)
           if not JS.is_function_table(curr):
             advised.add(curr)
           if curr in can_call:
@@ -2451,14 +3138,8 @@ class Building(object):
         raise Exception('closure compiler check failed')
 
       CLOSURE_EXTERNS = path_from_root('src', 'closure-externs.js')
-      NODE_EXTERNS_BASE = path_from_root('third_party', 'closure-compiler', 'node-externs')
-      NODE_EXTERNS = os.listdir(NODE_EXTERNS_BASE)
-      NODE_EXTERNS = [os.path.join(NODE_EXTERNS_BASE, name) for name in NODE_EXTERNS
-                      if name.endswith('.js')]
-      BROWSER_EXTERNS_BASE = path_from_root('third_party', 'closure-compiler', 'browser-externs')
-      BROWSER_EXTERNS = os.listdir(BROWSER_EXTERNS_BASE)
-      BROWSER_EXTERNS = [os.path.join(BROWSER_EXTERNS_BASE, name) for name in BROWSER_EXTERNS
-                         if name.endswith('.js')]
+      NODE_EXTERNS = list_closure_externs(path_from_root('third_party', 'closure-compiler', 'node-externs'))
+      BROWSER_EXTERNS = list_closure_externs(path_from_root('third_party', 'closure-compiler', 'browser-externs'))
 
       # Something like this (adjust memory as needed):
       #   java -Xmx1024m -jar CLOSURE_COMPILER --compilation_level ADVANCED_OPTIMIZATIONS --variable_map_output_file src.cpp.o.js.vars --js src.cpp.o.js --js_output_file src.cpp.o.cc.js
@@ -2482,7 +3163,7 @@ class Building(object):
         args += ['--formatting', 'PRETTY_PRINT']
       if os.environ.get('EMCC_CLOSURE_ARGS'):
         args += shlex.split(os.environ.get('EMCC_CLOSURE_ARGS'))
-      logging.debug('closure compiler: ' + ' '.join(args))
+      logging.debug('closure compiler: %s', ' '.join(args))
       process = run_process(args, stdout=PIPE, stderr=STDOUT, check=False)
       if process.returncode != 0 or not os.path.exists(filename + '.cc.js'):
         raise Exception('closure compiler error: ' + process.stdout + ' (rc: %d)' % process.returncode)
@@ -2502,7 +3183,7 @@ class Building(object):
     if minify_whitespace:
       passes.append('minifyWhitespace')
     if passes:
-      logging.debug('running cleanup on shell code: ' + ' '.join(passes))
+      logging.debug('running cleanup on shell code: %s', ' '.join(passes))
       js_file = Building.js_optimizer_no_asmjs(js_file, ['noPrintMetadata'] + passes)
     # if we can optimize this js+wasm combination under the assumption no one else
     # will see the internals, do so
@@ -2516,7 +3197,7 @@ class Building(object):
         passes = ['noPrintMetadata', 'AJSDCE']
         if minify_whitespace:
           passes.append('minifyWhitespace')
-        logging.debug('running post-meta-DCE cleanup on shell code: ' + ' '.join(passes))
+        logging.debug('running post-meta-DCE cleanup on shell code: %s', ' '.join(passes))
         js_file = Building.js_optimizer_no_asmjs(js_file, passes)
       # finally, optionally use closure compiler to finish cleaning up the JS
       if use_closure_compiler:
@@ -2572,71 +3253,86 @@ class Building(object):
 
   # the exports the user requested
   user_requested_exports = []
+  # Results of sniffing file headers, keyed on path, mtime and size, so that a
+  # file that is rewritten is looked at again. The same inputs are checked many
+  # times during a link.
   _is_ar_cache = {}
+  _is_bitcode_cache = {}
+
+  @staticmethod
+  def file_cache_key(filename):
+    st = os.stat(filename)
+    return (filename, st.st_mtime, st.st_size)
 
   @staticmethod
   def is_ar(filename):
     try:
-      if Building._is_ar_cache.get(filename):
-        return Building._is_ar_cache[filename]
-      b = bytearray(open(filename, 'rb').read(8))
-      sigcheck = b[0] == ord('!') and b[1] == ord('<') and \
-                 b[2] == ord('a') and b[3] == ord('r') and \
-                 b[4] == ord('c') and b[5] == ord('h') and \
-                 b[6] == ord('>') and b[7] == 10
-      Building._is_ar_cache[filename] = sigcheck
+      key = Building.file_cache_key(filename)
+      if key in Building._is_ar_cache:
+        return Building._is_ar_cache[key]
+      with open(filename, 'rb') as f:
+        sigcheck = f.read(8) == AR_SIGNATURE
+      Building._is_ar_cache[key] = sigcheck
       return sigcheck
     except Exception as e:
-      logging.debug('Building.is_ar failed to test whether file \'%s\' is a llvm archive file! Failed on exception: %s' % (filename, e))
+      logging.debug('Building.is_ar failed to test whether file \'%s\' is a llvm archive file! Failed on exception: %s', filename, e)
       return False
 
   @staticmethod
   def is_bitcode(filename):
+    key = Building.file_cache_key(filename)
+    if key not in Building._is_bitcode_cache:
+      Building._is_bitcode_cache[key] = Building.is_bitcode_uncached(filename)
+    return Building._is_bitcode_cache[key]
+
+  @staticmethod
+  def is_bitcode_uncached(filename):
     # look for magic signature
-    b = bytearray(open(filename, 'rb').read(4))
+    with open(filename, 'rb') as f:
+      b = f.read(24)
     if len(b) < 4:
       return False
-    if b[0] == ord('B') and b[1] == ord('C'):
+    if b[:2] == BITCODE_SIGNATURE:
       return True
-    # look for ar signature
-    elif Building.is_ar(filename):
+    # look for ar signature (the same check as is_ar, on the bytes we already have)
+    elif b[:8] == AR_SIGNATURE:
       return True
     # on macOS, there is a 20-byte prefix
-    elif b[0] == 222 and b[1] == 192 and b[2] == 23 and b[3] == 11:
-      b = bytearray(open(filename, 'rb').read(24))
-      return b[20] == ord('B') and b[21] == ord('C')
+    elif b[:4] == BITCODE_WRAPPER_SIGNATURE:
+      return b[20:22] == BITCODE_SIGNATURE
 
     return False
 
+  # Some native libraries are implemented in Emscripten as system side JS libraries
+  JS_SYSTEM_LIBRARIES = {
+    'c': '',
+    'dl': '',
+    'EGL': 'library_egl.js',
+    'GL': 'library_gl.js',
+    'GLESv2': 'library_gl.js',
+    'GLEW': 'library_glew.js',
+    'glfw': 'library_glfw.js',
+    'glfw3': 'library_glfw.js',
+    'GLU': '',
+    'glut': 'library_glut.js',
+    'm': '',
+    'openal': 'library_openal.js',
+    'rt': '',
+    'pthread': '',
+    'X11': 'library_xlib.js',
+    'SDL': 'library_sdl.js',
+    'stdc++': '',
+    'uuid': 'library_uuid.js'
+  }
+
   @staticmethod
   # Given the name of a special Emscripten-implemented system library, returns an array of absolute paths to JS library
   # files inside emscripten/src/ that corresponds to the library name.
   def path_to_system_js_libraries(library_name):
-    # Some native libraries are implemented in Emscripten as system side JS libraries
-    js_system_libraries = {
-      'c': '',
-      'dl': '',
-      'EGL': 'library_egl.js',
-      'GL': 'library_gl.js',
-      'GLESv2': 'library_gl.js',
-      'GLEW': 'library_glew.js',
-      'glfw': 'library_glfw.js',
-      'glfw3': 'library_glfw.js',
-      'GLU': '',
-      'glut': 'library_glut.js',
-      'm': '',
-      'openal': 'library_openal.js',
-      'rt': '',
-      'pthread': '',
-      'X11': 'library_xlib.js',
-      'SDL': 'library_sdl.js',
-      'stdc++': '',
-      'uuid': 'library_uuid.js'
-    }
     library_files = []
-    if library_name in js_system_libraries:
-      if len(js_system_libraries[library_name]):
-        library_files += [js_system_libraries[library_name]]
+    if library_name in Building.JS_SYSTEM_LIBRARIES:
+      if len(Building.JS_SYSTEM_LIBRARIES[library_name]):
+        library_files += [Building.JS_SYSTEM_LIBRARIES[library_name]]
 
         # TODO: This is unintentional due to historical reasons. Improve EGL to use HTML5 API to avoid depending on GLUT.
         if library_name == 'EGL':
@@ -2715,15 +3411,21 @@ class FilenameReplacementStrings:
 
 
 class JS(object):
-  memory_initializer_pattern = '/\* memory initializer \*/ allocate\(\[([\d, ]*)\], "i8", ALLOC_NONE, ([\d+\.GLOBAL_BASEHgb]+)\);'
-  no_memory_initializer_pattern = '/\* no memory initializer \*/'
+  memory_initializer_pattern = re.compile(r'/\* memory initializer \*/ allocate\(\[([\d, ]*)\], "i8", ALLOC_NONE, ([\d+\.GLOBAL_BASEHgb]+)\);')
+  no_memory_initializer_pattern = re.compile(r'/\* no memory initializer \*/')
 
-  memory_staticbump_pattern = 'STATICTOP = STATIC_BASE \+ (\d+);'
+  memory_staticbump_pattern = re.compile(r'STATICTOP = STATIC_BASE \+ (\d+);')
 
-  global_initializers_pattern = '/\* global initializers \*/ __ATINIT__.push\((.+)\);'
+  global_initializers_pattern = re.compile(r'/\* global initializers \*/ __ATINIT__.push\((.+)\);')
 
   module_export_name_substitution_pattern = '"__EMSCRIPTEN_PRIVATE_MODULE_EXPORT_NAME_SUBSTITUTION__"'
 
+  # how generate_string_initializer escapes characters for a single-quoted JS
+  # string. besides the quote and the usual escapes, this covers the ^Z (= 0x1a =
+  # substitute) ASCII character and all characters higher than 7-bit ASCII.
+  string_initializer_escapes = dict((c, u'\\x%02x' % c) for c in [0x1a] + list(range(0x80, 0x100)))
+  string_initializer_escapes.update({ord('\\'): u'\\\\', ord("'"): u"\\'", ord('\n'): u'\\n', ord('\r'): u'\\r'})
+
   @staticmethod
   def to_nice_ident(ident): # limited version of the JS function toNiceIdent
     return ident.replace('%', '$').replace('@', '_').replace('.', '_')
@@ -2740,13 +3442,31 @@ class JS(object):
     if data_uri is None:
       data_uri = Settings.SINGLE_FILE
     if data_uri:
-      f = open(path, 'rb')
-      data = base64.b64encode(f.read())
-      f.close()
+      with open(path, 'rb') as f:
+        # encode straight from a mapping of the file, rather than reading it into
+        # memory first (mmap can't map empty files)
+        try:
+          contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+          data = base64.b64encode(f.read())
+        else:
+          try:
+            data = base64.b64encode(contents)
+          finally:
+            contents.close()
       return 'data:application/octet-stream;base64,' + asstr(data)
     else:
       return os.path.basename(path)
 
+  # the SIMD.js type of each SIMD signature character
+  SIMD_TYPES = {
+    'F': 'SIMD_Float32x4',
+    'D': 'SIMD_Float64x2',
+    'B': 'SIMD_Int8x16',
+    'S': 'SIMD_Int16x8',
+    'I': 'SIMD_Int32x4',
+  }
+
   @staticmethod
   def make_initializer(sig, settings=None):
     settings = settings or Settings
@@ -2758,16 +3478,9 @@ class JS(object):
       if settings:
         assert settings['WASM'], 'j aka i64 only makes sense in wasm-only mode in binaryen'
       return 'i64(0)'
-    elif sig == 'F':
-      return 'SIMD_Float32x4_check(SIMD_Float32x4(0,0,0,0))'
-    elif sig == 'D':
-      return 'SIMD_Float64x2_check(SIMD_Float64x2(0,0,0,0))'
-    elif sig == 'B':
-      return 'SIMD_Int8x16_check(SIMD_Int8x16(0,0,0,0))'
-    elif sig == 'S':
-      return 'SIMD_Int16x8_check(SIMD_Int16x8(0,0,0,0))'
-    elif sig == 'I':
-      return 'SIMD_Int32x4_check(SIMD_Int32x4(0,0,0,0))'
+    elif sig in JS.SIMD_TYPES:
+      simd_type = JS.SIMD_TYPES[sig]
+      return '%s_check(%s(0,0,0,0))' % (simd_type, simd_type)
     else:
       return '+0'
 
@@ -2795,16 +3508,8 @@ class JS(object):
       if settings:
         assert settings['WASM'], 'j aka i64 only makes sense in wasm-only mode in binaryen'
       return 'i64(' + value + ')'
-    elif sig == 'F':
-      return 'SIMD_Float32x4_check(' + value + ')'
-    elif sig == 'D':
-      return 'SIMD_Float64x2_check(' + value + ')'
-    elif sig == 'B':
-      return 'SIMD_Int8x16_check(' + value + ')'
-    elif sig == 'S':
-      return 'SIMD_Int16x8_check(' + value + ')'
-    elif sig == 'I':
-      return 'SIMD_Int32x4_check(' + value + ')'
+    elif sig in JS.SIMD_TYPES:
+      return JS.SIMD_TYPES[sig] + '_check(' + value + ')'
     else:
       return value
 
@@ -2874,37 +3579,21 @@ class JS(object):
 
   @staticmethod
   def align(x, by):
-    while x % by != 0:
-      x += 1
-    return x
+    # round up to the next multiple of by
+    return ((x + by - 1) // by) * by
 
   @staticmethod
   def generate_string_initializer(s):
     if Settings.ASSERTIONS:
-      # append checksum of length and content
-      crcTable = []
-      for i in range(256):
-        crc = i
-        for bit in range(8):
-          crc = (crc >> 1) ^ ((crc & 1) * 0xedb88320)
-        crcTable.append(crc)
-      crc = 0xffffffff
+      # append checksum of length and content. this is a standard crc32 of the two
+      # low bytes of the length followed by the content, without the final xor
       n = len(s)
-      crc = crcTable[(crc ^ n) & 0xff] ^ (crc >> 8)
-      crc = crcTable[(crc ^ (n >> 8)) & 0xff] ^ (crc >> 8)
-      for i in s:
-        crc = crcTable[(crc ^ i) & 0xff] ^ (crc >> 8)
+      crc = (zlib.crc32(bytes(bytearray([n & 0xff, (n >> 8) & 0xff] + s))) & 0xffffffff) ^ 0xffffffff
       for i in range(4):
         s.append((crc >> (8 * i)) & 0xff)
-    s = ''.join(map(chr, s))
-    s = s.replace('\\', '\\\\').replace("'", "\\'")
-    s = s.replace('\n', '\\n').replace('\r', '\\r')
-
-    # Escape the ^Z (= 0x1a = substitute) ASCII character and all characters higher than 7-bit ASCII.
-    def escape(x):
-      return '\\x{:02x}'.format(ord(x.group()))
-
-    return re.sub('[\x1a\x80-\xff]', escape, s)
+    # decoding as latin-1 maps each byte to the character with the same code, and
+    # lets the escaping be done in a single translate pass
+    return asstr(bytes(bytearray(s)).decode('latin-1').translate(JS.string_initializer_escapes))
 
   @staticmethod
   def is_dyn_call(func):
@@ -2919,17 +3608,12 @@ class WebAssembly(object):
   @staticmethod
   def lebify(x):
     assert x >= 0, 'TODO: signed'
-    ret = []
-    while 1:
-      byte = x & 127
+    ret = bytearray()
+    while x >= 128:
+      ret.append((x & 127) | 128)
       x >>= 7
-      more = x != 0
-      if more:
-        byte = byte | 128
-      ret.append(byte)
-      if not more:
-        break
-    return bytearray(ret)
+    ret.append(x)
+    return ret
 
   @staticmethod
   def make_shared_library(js_file, wasm_file):
@@ -2942,25 +3626,25 @@ class WebAssembly(object):
     m = re.search('gb = alignMemory\(getMemory\(\d+ \+ (\d+)\), (\d+) \|\| 1\);', js)
     assert m.group(1) == m.group(2), 'js must contain a clear alignment for the wasm shared library'
     mem_align = int(m.group(1))
-    mem_align = int(math.log(mem_align, 2))
-    logging.debug('creating wasm dynamic library with mem size %d, table size %d, align %d' % (mem_size, table_size, mem_align))
+    assert mem_align > 0 and (mem_align & (mem_align - 1)) == 0, 'wasm shared library alignment must be a power of 2'
+    mem_align = mem_align.bit_length() - 1 # log2
+    logging.debug('creating wasm dynamic library with mem size %d, table size %d, align %d', mem_size, table_size, mem_align)
     wso = js_file + '.wso'
-    # write the binary
-    wasm = open(wasm_file, 'rb').read()
-    f = open(wso, 'wb')
-    f.write(wasm[0:8]) # copy magic number and version
-    # write the special section
-    f.write(b'\0') # user section is code 0
-    # need to find the size of this section
-    name = b"\06dylink" # section name, including prefixed size
-    contents = (WebAssembly.lebify(mem_size) + WebAssembly.lebify(mem_align) +
-                WebAssembly.lebify(table_size) + WebAssembly.lebify(0))
-    size = len(name) + len(contents)
-    f.write(WebAssembly.lebify(size))
-    f.write(name)
-    f.write(contents)
-    f.write(wasm[8:]) # copy rest of binary
-    f.close()
+    # write the binary, streaming the original one into it rather than reading it
+    # all into memory
+    with open(wasm_file, 'rb') as wasm, open(wso, 'wb') as f:
+      f.write(wasm.read(8)) # copy magic number and version
+      # write the special section
+      f.write(b'\0') # user section is code 0
+      # need to find the size of this section
+      name = b"\06dylink" # section name, including prefixed size
+      contents = (WebAssembly.lebify(mem_size) + WebAssembly.lebify(mem_align) +
+                  WebAssembly.lebify(table_size) + WebAssembly.lebify(0))
+      size = len(name) + len(contents)
+      f.write(WebAssembly.lebify(size))
+      f.write(name)
+      f.write(contents)
+      shutil.copyfileobj(wasm, f, 1 << 20) # copy rest of binary
     return wso
 
 
@@ -2983,11 +3667,13 @@ def asbytes(s):
   return s.encode('utf-8')
 
 
+@memoize
 def suffix(name):
   """Return the file extension *not* including the '.'."""
   return os.path.splitext(name)[1][1:]
 
 
+@memoize
 def unsuffixed(name):
   """Return the filename without the extention.
 
@@ -2996,10 +3682,16 @@ def unsuffixed(name):
   return os.path.splitext(name)[0]
 
 
+@memoize
 def unsuffixed_basename(name):
   return os.path.basename(unsuffixed(name))
 
 
+# os.replace is Python 3 only; os.rename also overwrites an existing destination on POSIX,
+# and where it does not, safe_move falls back to shutil.move
+os_replace = getattr(os, 'replace', os.rename)
+
+
 def safe_move(src, dst):
   src = os.path.abspath(src)
   dst = os.path.abspath(dst)
@@ -3009,6 +3701,13 @@ def safe_move(src, dst):
     return
   if dst == '/dev/null':
     return
+  # a plain rename is all that is needed when staying on the same filesystem;
+  # shutil.move copies instead when that fails (e.g. across devices)
+  try:
+    os_replace(src, dst)
+    return
+  except OSError:
+    pass
   shutil.move(src, dst)
 
 
@@ -3021,67 +3720,160 @@ def safe_copy(src, dst):
     return
   if dst == '/dev/null':
     return
+  copy_file_contents(src, dst)
+
+
+# Like shutil.copyfile, but lets the kernel do the copy with copy_file_range where
+# available (Linux, Python 3.8+), which avoids copying through userspace and can
+# share the data on filesystems that support reflinks.
+def copy_file_contents(src, dst):
+  if hasattr(os, 'copy_file_range'):
+    try:
+      with open(src, 'rb') as fsrc:
+        st = os.fstat(fsrc.fileno())
+        # only a regular file's size says how much there is to copy (procfs
+        # files, pipes etc. report 0), so leave anything else to shutil
+        if stat.S_ISREG(st.st_mode) and st.st_size > 0:
+          remaining = st.st_size
+          with open(dst, 'wb') as fdst:
+            while remaining > 0:
+              copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+              if not copied:
+                break
+              remaining -= copied
+          if remaining == 0:
+            return
+          # the file shrank or the copy stopped early; start over below
+          try_delete(dst)
+    except OSError:
+      # e.g. copying across filesystems on older kernels
+      try_delete(dst)
   shutil.copyfile(src, dst)
 
 
+# the #include lines clang_preprocess follows, "quoted" or <angled>
+C_INCLUDE_PATTERN = re.compile(r'^\s*#\s*include\s*([<"])([^>"]+)[>"]', re.M)
+
+
 def clang_preprocess(filename):
   # TODO: REMOVE HACK AND PASS PREPROCESSOR FLAGS TO CLANG.
-  return run_process([CLANG_CC, '-DFETCH_DEBUG=1', '-E', '-P', '-C', '-x', 'c', filename], check=True, stdout=subprocess.PIPE).stdout
+  cmd = [CLANG_CC, '-DFETCH_DEBUG=1', '-E', '-P', '-C', '-x', 'c', filename]
+
+  # the output only depends on the command, clang itself and the files it reads
+  # (the file and what it #includes), so keep it in the cache, under a name that
+  # changes along with them. An include that is not next to its includer is
+  # keyed on just that, as clang might find it elsewhere (or skip it, e.g. in an
+  # #if 0), and <angled> ones come from clang's own headers.
+  def stat_key(f):
+    try:
+      st = os.stat(f)
+      return [f, st.st_mtime, st.st_size]
+    except OSError:
+      return [f, None, None]
+
+  inputs = [stat_key(CLANG_CC)]
+  seen = set()
+  to_check = [filename]
+  while to_check:
+    f = to_check.pop()
+    if f in seen:
+      continue
+    seen.add(f)
+    inputs.append(stat_key(f))
+    try:
+      with open(f) as src:
+        includes = C_INCLUDE_PATTERN.findall(src.read())
+    except (IOError, OSError):
+      continue
+    for kind, include in includes:
+      if kind == '"':
+        to_check.append(os.path.join(os.path.dirname(f), include))
+      else:
+        inputs.append(['<%s>' % include])
+  key = hashlib.sha1(asbytes(json.dumps([cmd] + inputs))).hexdigest()
+  shortname = '%s_preprocessed_%s' % (unsuffixed_basename(filename), key)
+
+  def create():
+    # run clang before opening the output, so a failure can't leave an empty
+    # file in the cache
+    preprocessed = run_process(cmd, check=True, stdout=subprocess.PIPE).stdout
+    output = Cache.get_path(shortname + '.js')
+    with open(output, 'w') as f:
+      f.write(preprocessed)
+    return output
+
+  with open(Cache.get(shortname, create, extension='.js')) as f:
+    return f.read()
+
+
+# the last contents written to each settings file for the JS preprocessor
+_preprocessor_settings_files = {}
 
 
 def read_and_preprocess(filename):
   temp_dir = get_emscripten_temp_dir()
   # Create a settings file with the current settings to pass to the JS preprocessor
-  # Note: Settings.serialize returns an array of -s options i.e. ['-s', '<setting1>', '-s', '<setting2>', ...]
-  #       we only want the actual settings, hence the [1::2] slice operation.
-  settings_str = "var " + ";\nvar ".join(Settings.serialize()[1::2])
+  settings_str = Settings.as_js_vars()
   settings_file = os.path.join(temp_dir, 'settings.js')
-  open(settings_file, 'w').write(settings_str)
+  # the settings rarely change between calls, so only rewrite the file when they do
+  if _preprocessor_settings_files.get(settings_file) != settings_str or not os.path.exists(settings_file):
+    with open(settings_file, 'w') as f:
+      f.write(settings_str)
+    _preprocessor_settings_files[settings_file] = settings_str
 
   # Run the JS preprocessor
-  # N.B. We can't use the default stdout=PIPE here as it only allows 64K of output before it hangs
-  # and shell.html is bigger than that!
+  # N.B. This must not use run_js's timeout: with one, it waits for the process to exit before reading
+  # stdout=PIPE, which hangs once the output is more than the 64K a pipe buffers (and shell.html is
+  # bigger than that!). Without one, it reads the pipe with communicate(), which keeps draining it.
   # See https://thraxil.org/users/anders/posts/2008/03/13/Subprocess-Hanging-PIPE-is-your-enemy/
   (path, file) = os.path.split(filename)
   if not path:
     path = None
-  stdout = os.path.join(temp_dir, 'stdout')
   args = [settings_file, file]
 
-  run_js(path_from_root('tools/preprocessor.js'), NODE_JS, args, True, stdout=open(stdout, 'w'), cwd=path)
-  out = open(stdout, 'r').read()
+  return run_js(PREPROCESSOR, NODE_JS, args, stdout=PIPE, cwd=path)
+
+
+BRACE_PATTERN = re.compile('[{}]')
 
-  return out
+FETCH_WORKER_FUNCS = ('alignUp', 'getTotalMemory', 'stringToUTF8', 'intArrayFromString', 'lengthBytesUTF8', 'stringToUTF8Array', '_emscripten_is_main_runtime_thread', '_emscripten_futex_wait')
+FETCH_WORKER_ASM_FUNCS = ('_malloc', '_free', '_sbrk', '___pthread_mutex_lock', '___pthread_mutex_unlock')
+FETCH_WORKER_PATTERN = re.compile('function (' + '|'.join(re.escape(func) for func in FETCH_WORKER_FUNCS + FETCH_WORKER_ASM_FUNCS) + r')\(')
 
 
 # Generates a suitable fetch-worker.js script from the given input source JS file (which is an asm.js build output),
 # and writes it out to location output_file. fetch-worker.js is the root entry point for a dedicated filesystem web
 # worker in -s ASMFS=1 mode.
 def make_fetch_worker(source_file, output_file):
-  src = open(source_file, 'r').read()
-  funcs_to_import = ['alignUp', 'getTotalMemory', 'stringToUTF8', 'intArrayFromString', 'lengthBytesUTF8', 'stringToUTF8Array', '_emscripten_is_main_runtime_thread', '_emscripten_futex_wait']
-  asm_funcs_to_import = ['_malloc', '_free', '_sbrk', '___pthread_mutex_lock', '___pthread_mutex_unlock']
-  function_prologue = '''this.onerror = function(e) {
+  with open(source_file, 'r') as f:
+    src = f.read()
+  function_prologue = ['''this.onerror = function(e) {
   console.error(e);
 }
 
-'''
+''']
   asm_start = src.find('// EMSCRIPTEN_START_ASM')
-  for func in funcs_to_import + asm_funcs_to_import:
-    loc = src.find('function ' + func + '(', asm_start if func in asm_funcs_to_import else 0)
+  # find the first definition of each function (the asm ones inside the asm module)
+  # in a single pass over the source
+  func_locs = {}
+  for m in FETCH_WORKER_PATTERN.finditer(src):
+    func = m.group(1)
+    if func not in func_locs and (func not in FETCH_WORKER_ASM_FUNCS or m.start() >= asm_start):
+      func_locs[func] = m.start()
+  for func in FETCH_WORKER_FUNCS + FETCH_WORKER_ASM_FUNCS:
+    loc = func_locs.get(func, -1)
     if loc == -1:
       exit_with_error('failed to find function %s!', func)
     end_loc = src.find('{', loc) + 1
     nesting_level = 1
-    while nesting_level > 0:
-      if src[end_loc] == '{':
-        nesting_level += 1
-      if src[end_loc] == '}':
-        nesting_level -= 1
-      end_loc += 1
-
-    func_code = src[loc:end_loc]
-    function_prologue = function_prologue + '\n' + func_code
-
-  fetch_worker_src = function_prologue + '\n' + clang_preprocess(path_from_root('src', 'fetch-worker.js'))
-  open(output_file, 'w').write(fetch_worker_src)
+    for brace in BRACE_PATTERN.finditer(src, end_loc):
+      nesting_level += 1 if brace.group() == '{' else -1
+      if nesting_level == 0:
+        end_loc = brace.end()
+        break
+
+    function_prologue.append(src[loc:end_loc])
+
+  fetch_worker_src = '\n'.join(function_prologue) + '\n' + clang_preprocess(FETCH_WORKER_SRC)
+  with open(output_file, 'w') as f:
+    f.write(fetch_worker_src)
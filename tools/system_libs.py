@@ -35,6 +35,24 @@ def run_commands(commands):
     pool.map_async(call_process, commands, chunksize=1).get(999999)
 
 
+# Returns commands that compile the given sources with a few emcc invocations
+# rather than one per source, and the bitcode files they produce. Each command
+# compiles a chunk of the sources and links it into a single bitcode file, which
+# saves starting emcc for every source. That is only valid for libraries that are
+# linked as a whole (.bc), not for archives, whose members are picked on demand.
+# There are about two chunks per core, so that the chunks still keep all the
+# cores busy, and they keep the original order of the sources.
+def chunked_compile_commands(compiler, srcs, output_base, args):
+  chunk_size = max(1, (len(srcs) + 2 * CORES - 1) // (2 * CORES))
+  commands = []
+  outputs = []
+  for i in range(0, len(srcs), chunk_size):
+    output = '%s.%d.o' % (output_base, len(outputs))
+    commands.append([shared.PYTHON, compiler] + srcs[i:i + chunk_size] + ['-o', output] + args)
+    outputs.append(output)
+  return commands, outputs
+
+
 def files_in_path(path_components, filenames):
   srcdir = shared.path_from_root(*path_components)
   return [os.path.join(srcdir, f) for f in filenames]
@@ -88,10 +106,14 @@ def calculate(temp_files, in_temp, stdout_, stderr_, forced=[]):
               '-Wno-logical-op-parentheses', '-Wno-bitwise-op-parentheses',
               '-Wno-visibility', '-Wno-pointer-sign', '-Wno-absolute-value',
               '-Wno-empty-body']
-    for src in files:
-      o = in_temp(os.path.basename(src) + '.o')
-      commands.append([shared.PYTHON, shared.EMCC, shared.path_from_root('system', 'lib', src), '-o', o] + musl_internal_includes() + default_opts + c_opts + lib_opts)
-      o_s.append(o)
+    args = musl_internal_includes() + default_opts + c_opts + lib_opts
+    if lib_filename.endswith('.bc'):
+      commands, o_s = chunked_compile_commands(shared.EMCC, [shared.path_from_root('system', 'lib', src) for src in files], in_temp(lib_filename), args)
+    else:
+      for src in files:
+        o = in_temp(os.path.basename(src) + '.o')
+        commands.append([shared.PYTHON, shared.EMCC, shared.path_from_root('system', 'lib', src), '-o', o] + args)
+        o_s.append(o)
     run_commands(commands)
     shared.Building.link(o_s, in_temp(lib_filename))
     return in_temp(lib_filename)
@@ -102,11 +124,14 @@ def calculate(temp_files, in_temp, stdout_, stderr_, forced=[]):
     opts = default_opts + lib_opts
     if has_noexcept_version and shared.Settings.DISABLE_EXCEPTION_CATCHING:
       opts += ['-fno-exceptions']
-    for src in files:
-      o = in_temp(src + '.o')
-      srcfile = shared.path_from_root(src_dirname, src)
-      commands.append([shared.PYTHON, shared.EMXX, srcfile, '-o', o, '-std=c++11'] + opts)
-      o_s.append(o)
+    if lib_filename.endswith('.bc'):
+      commands, o_s = chunked_compile_commands(shared.EMXX, [shared.path_from_root(src_dirname, src) for src in files], in_temp(lib_filename), ['-std=c++11'] + opts)
+    else:
+      for src in files:
+        o = in_temp(src + '.o')
+        srcfile = shared.path_from_root(src_dirname, src)
+        commands.append([shared.PYTHON, shared.EMXX, srcfile, '-o', o, '-std=c++11'] + opts)
+        o_s.append(o)
     run_commands(commands)
     if lib_filename.endswith('.bc'):
       shared.Building.link(o_s, in_temp(lib_filename))